@@ -0,0 +1,142 @@
+# Event-driven stand-in for gym_donkeycar's SDClient.
+#
+# SDClient runs a thread that wakes up every poll_socket_sleep_time to check
+# the socket, so every message in or out waits up to one poll interval. This
+# runs an asyncio event loop on its own thread instead: incoming
+# newline-delimited JSON is handed to on_msg_recv as soon as the line arrives,
+# and send() writes straight to the socket. The interface (send, send_now,
+# on_msg_recv, stop, aborted, poll_socket_sleep_sec) matches SDClient so the
+# clients built on client.Client run on either one.
+
+import asyncio
+import re
+import threading
+import time
+import traceback
+
+import telemetry
+
+# the sim sends whole camera frames inside a single line, so the default
+# 64 KiB StreamReader limit is far too small for anything past 160x120
+READ_LIMIT = 2 ** 26
+
+
+class AsyncSDClient:
+
+    def __init__(self, host, port, poll_socket_sleep_time=0.0):
+        self.host = host
+        self.port = port
+        # nothing to poll: kept so callers that read it still work
+        self.poll_socket_sleep_sec = 0.0
+        self.aborted = False
+        self.recv_time = None
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        self.loop = asyncio.new_event_loop()
+        self.th = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.th.start()
+        self.connect()
+
+    def connect(self):
+        future = asyncio.run_coroutine_threadsafe(self.open_connection(), self.loop)
+        try:
+            future.result()
+        except ConnectionRefusedError:
+            self.stop_loop()
+            raise Exception("Could not connect to server. Is it running?")
+        self.reader_task = asyncio.run_coroutine_threadsafe(self.proc_msg(), self.loop)
+
+    async def open_connection(self):
+        self.reader, self.writer = await asyncio.open_connection(
+            self.host, self.port, limit=READ_LIMIT)
+
+    async def proc_msg(self):
+        while True:
+            try:
+                line = await self.reader.readline()
+            except (ConnectionError, ValueError) as e:
+                print(f"socket read failed: {e}")
+                self.aborted = True
+                return
+            if not line:
+                # server closed the connection
+                self.aborted = True
+                return
+            if len(line) <= 2:
+                continue
+            self.recv_time = time.perf_counter()
+            json_packet = self.parse_msg(line)
+            if json_packet is None:
+                continue
+            try:
+                self.on_msg_recv(json_packet)
+            except Exception:
+                traceback.print_exc()
+
+    def parse_msg(self, line):
+        try:
+            json_packet = telemetry.loads(line)
+        except ValueError:
+            # sims running under a non-English locale write floats with commas
+            try:
+                json_packet = telemetry.loads(
+                    fix_float_notation(line.decode('utf-8')).encode('utf-8'))
+            except ValueError as e:
+                print(f"bad json from sim: {e}")
+                return None
+        if 'msg_type' not in json_packet:
+            print("expected msg_type field")
+            return None
+        return json_packet
+
+    def on_msg_recv(self, json_packet):
+        pass
+
+    def send(self, msg):
+        data = msg.encode('utf-8')
+        if threading.current_thread() is self.th:
+            # already on the loop (e.g. replying from on_msg_recv)
+            self.writer.write(data)
+        else:
+            self.loop.call_soon_threadsafe(self.writer.write, data)
+
+    # SDClient.send only queues for its poll thread, send_now writes
+    # immediately. Here both write immediately.
+    send_now = send
+
+    async def close(self):
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    def stop(self):
+        if self.loop.is_closed():
+            return
+        if threading.current_thread() is self.th:
+            # can't wait on ourselves; finish closing on the loop
+            self.loop.create_task(self.close()).add_done_callback(
+                lambda _: self.loop.stop())
+            return
+        if self.th.is_alive():
+            try:
+                asyncio.run_coroutine_threadsafe(self.close(), self.loop).result(timeout=2.0)
+            except Exception as e:
+                print(f"error closing socket: {e}")
+        self.stop_loop()
+
+    def stop_loop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.th.join()
+        self.loop.close()
+
+
+FLOAT_NOTATION = re.compile(r'("[a-zA-Z_]+":)(-?[0-9]+),([0-9]+(?:E-?[0-9]+)?)([,}])')
+
+def fix_float_notation(msg):
+    return FLOAT_NOTATION.sub(r'\1\2.\3\4', msg)
@@ -1,31 +1,43 @@
 import argparse
-import base64
 import time
-from io import BytesIO
-from PIL import Image
 
-from config import auto_timeout, image_depth, trial_laps
-from pilot import Autopilot
+from config import (auto_timeout, black_box, cam_conf, frame_ring_size, image_depth,
+                    latency_compensation, trial_laps)
+from pilot import Autopilot, InferenceWorker
 from client import Client
-from sim_recorder import SimRecorder
+from compensation import LatencyCompensator
+from sim_recorder import BlackBoxRecorder, SimRecorder
+from telemetry import FrameRing
 
 
 class AutoClient(Client):
 
     def __init__(self, address, conf, poll_socket_sleep_time=0.01):
         self.pilot = Autopilot(conf)
+        self.frames = FrameRing(cam_conf, image_depth, self.pilot.image_dtype, frame_ring_size)
+        # telemetry can arrive as soon as we connect, so this goes first
+        self.inference = InferenceWorker(self.pilot)
+        self.compensator = LatencyCompensator() if latency_compensation else None
         self.mode = conf['mode']
         self.current_image = None
         self.current_telem = None
-        self.fresh_data = False
         self.later_lap_sum = 0
 
         # give time for the autopilot to start up
         # time.sleep(1)
 
         super().__init__(address, conf=conf, poll_socket_sleep_time=poll_socket_sleep_time)
+        self.inference.latency = self.latency
+        if self.compensator:
+            # told when a control actually goes out on the socket
+            on_sent = self.controls.on_sent
+
+            def control_sent(sent_time):
+                on_sent(sent_time)
+                self.compensator.control_sent(sent_time)
+            self.controls.on_sent = control_sent
         if self.mode == 'train':
-            self.recorder = SimRecorder(conf)
+            self.recorder = BlackBoxRecorder(conf) if black_box else SimRecorder(conf)
             self.braking = 0.0
         if self.mode == 'trial':
             self.trial_times = []
@@ -45,21 +57,24 @@ class AutoClient(Client):
         if self.mode == 'train':
             data['brake'] = self.braking
             data['lap'] = self.current_lap
-            self.recorder.record(data)
+            with self.latency.stage('record'):
+                self.recorder.record(data)
 
     def update_telemetry(self, data):
-        # decode image
-        if image_depth  == 1:
-            self.current_image = Image.open(
-                BytesIO(base64.b64decode(data['image']))).getchannel(image_depth)
-        else:
-            self.current_image = Image.open(
-                BytesIO(base64.b64decode(data['image'])))
-            # add specified telemetry from json
+        # decode image (shared with the recorder through data.frame)
+        with self.latency.stage('decode'):
+            self.current_image = self.frames.put(data.frame.view(image_depth))
+        # add specified telemetry from json
         if 'first_lap' in self.pilot.telemetry_columns:
             data['first_lap'] = self.current_lap == 1
-        self.current_telem = [data[x] for x in self.pilot.telemetry_columns]
-        self.fresh_data = True
+        if self.compensator:
+            # where the car will be when this frame's control lands
+            self.compensator.frame_received(data['time'], self.recv_time or time.perf_counter())
+            state = self.compensator.extrapolate(data)
+            self.current_telem = [state.get(x, data[x]) for x in self.pilot.telemetry_columns]
+        else:
+            self.current_telem = [data[x] for x in self.pilot.telemetry_columns]
+        self.inference.submit(self.current_image, self.current_telem, data['time'])
         if self.mode == 'train':
             self.check_reset(data['time'], data['hit'])
     
@@ -71,27 +86,42 @@ class AutoClient(Client):
             crashed = hit != 'none'
             if timed_out: # or crashed:
                 print(f"{'Auto timeout' * timed_out}{'Crashed!' * crashed}")
+                if black_box and not self.reset_car:
+                    self.recorder.trigger('reset')
                 self.reset_car = True
                 # self.stop()
 
     def update(self):
-        steering, throttle, brake = 0.0, 0.0, 0.0
-        if not self.current_image:
+        if self.current_image is None:
             print("Waiting for first image")
             self.driving = False
             # return
-        if self.fresh_data:
-            inputs = self.current_image, self.current_telem
-            steering, throttle, brake = self.pilot.infer(inputs)
-            if brake < 0.01:
-                brake = 0
-            self.fresh_data = False
+        # paces the main loop: returns as soon as a new prediction is ready
+        prediction = self.inference.wait(timeout=0.1)
         if not self.driving:
             steering, throttle, brake = 0.0, 0.0, 1.0
+        elif prediction is None:
+            # nothing newer than what was last sent
+            return
+        else:
+            steering, throttle, brake, frame_time = prediction
+            if brake < 0.01:
+                brake = 0
+            if self.compensator:
+                steering = self.compensator.steer(steering, frame_time)
+                self.compensator.control_queued(frame_time)
         if self.mode == 'train':
             self.braking = brake
         self.send_controls(steering, throttle, brake)
 
+    def stop(self):
+        super().stop()
+        self.inference.stop()
+        if self.compensator:
+            self.compensator.report()
+        if self.mode == 'train':
+            self.recorder.close()
+
     def on_full_lap(self, lap_time):
         dirty_lap = self.hit_count > 0
         print(f"Lap {self.current_lap}: {lap_time:.2f}", end="")
@@ -102,6 +132,8 @@ class AutoClient(Client):
             later_lap_avg = self.later_lap_sum / (self.current_lap - 1)
             print(f" | avg: {later_lap_avg:.3f}", end="")        
         self.print_fastest_lap(lap_time)
+        if self.mode == 'train':
+            self.recorder.mark_lap(self.current_lap, lap_time)
         if self.mode == 'trial' and self.current_lap <= trial_laps:
             self.trial_times.append(lap_time)
             if self.current_lap > 1:
@@ -154,7 +186,7 @@ def run_client(conf):
                 client.driving = True
         except KeyboardInterrupt:
             run_sim = False
-        time.sleep(0.1)
+        # no sleep: update() waits (at most 0.1 s) for the next prediction
 
     # msg = '{ "msg_type" : "exit_scene" }'
     # client.send(msg)
@@ -205,6 +237,10 @@ if __name__ == "__main__":
                         help="autonomous driving mode",
                         choices=['race', 'train', 'trial']
                         )
+    parser.add_argument("--session",
+                        type=str,
+                        default=None,
+                        help="CSV session directory to resume, e.g. after a crash",)
 
     args = parser.parse_args()
     conf = {
@@ -218,6 +254,8 @@ if __name__ == "__main__":
         "image_depth": 1, # 1:'grayscale', 3:'rgb'
         "telem_type": 'donkey_extended_brake' # 'donkey_basic', 'donkey_extended_brake', 'gym'
     }
+    # set by the first recorder when None, so every reset records into one session
+    conf['session_dir'] = args.session
     while True: 
         refresh = run_client(conf)
         if not refresh:
@@ -0,0 +1,91 @@
+# Per-frame cost of turning a camera frame and telemetry into model inputs,
+# the old way (float64 image, array(), scaler.transform) against pilot's
+# Preprocessor.
+#
+#   python bench_preprocess.py --scaler ../scalers/scaler_12.pkl
+#
+# Without --scaler a StandardScaler is fitted on random telemetry.
+
+import argparse
+import time
+
+from pickle import load
+from types import SimpleNamespace
+
+import numpy as np
+from PIL import Image
+
+from config import cam_conf, image_depth
+from pilot import Preprocessor
+
+
+def old_preprocess(image, telem, scaler):
+    img = np.asarray(image, dtype=np.float64)
+    imu = np.array([telem])
+    imu_in = scaler.transform(imu) if scaler else imu
+    return img[None], imu_in
+
+
+def time_per_frame(fn, frames):
+    fn()
+    start = time.perf_counter()
+    for _ in range(frames):
+        fn()
+    return (time.perf_counter() - start) / frames
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="preprocessing microbenchmark")
+    parser.add_argument("--scaler",
+                        type=str,
+                        default=None,
+                        help="pickled scaler to use",)
+    parser.add_argument("--columns",
+                        type=int,
+                        default=10,
+                        help="telemetry columns when fitting a scaler",)
+    parser.add_argument("--frames",
+                        type=int,
+                        default=5000,
+                        help="frames to time each path over",)
+    parser.add_argument("--image_dtype",
+                        type=str,
+                        default='float32',
+                        help="the model's image input dtype",)
+
+    args = parser.parse_args()
+    rng = np.random.default_rng(0)
+    if args.scaler:
+        with open(args.scaler, 'rb') as pickle_file:
+            scaler = load(pickle_file)
+        columns = scaler.n_features_in_
+    else:
+        from sklearn.preprocessing import StandardScaler
+        columns = args.columns
+        scaler = StandardScaler().fit(rng.normal(3.0, 2.0, (1000, columns)))
+    shape = (cam_conf['img_h'], cam_conf['img_w']) + ((3,) if image_depth == 3 else ())
+    frame = rng.integers(0, 256, shape, dtype=np.uint8)
+    image = Image.fromarray(frame)
+    telem = list(rng.normal(3.0, 2.0, columns))
+
+    preprocess = Preprocessor(SimpleNamespace(image_dtype=args.image_dtype, imu_dtype='float32'),
+                              scaler, columns)
+    ring_frame = frame.astype(args.image_dtype)
+    old_img, old_imu = old_preprocess(image, telem, scaler)
+    new_img, new_imu = preprocess(frame, telem)
+    print(f"{type(scaler).__name__}, {columns} columns, {shape} frames, "
+          f"affine: {preprocess.scale is not None}")
+    print(f"max difference: image {np.abs(old_img - new_img).max():.2g}, "
+          f"telemetry {np.abs(old_imu - new_imu).max():.2g}")
+
+    paths = {
+        'old (PIL image, float64, transform)': lambda: old_preprocess(image, telem, scaler),
+        'new (uint8 frame, cast into buffer)': lambda: preprocess(frame, telem),
+        f'new (ring frame already {args.image_dtype})': lambda: preprocess(ring_frame, telem),
+    }
+    baseline = None
+    for name, fn in paths.items():
+        per_frame = time_per_frame(fn, args.frames)
+        baseline = baseline or per_frame
+        print(f"{name:44s} {per_frame * 1e6:8.1f} us/frame  {baseline / per_frame:5.1f}x")
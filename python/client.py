@@ -2,18 +2,36 @@
 # https://github.com/tawnkramer/sdsandbox/blob/master/src/test_client.py 
 # by tawnkramer (https://github.com/tawnkramer)
 
-import json
+import os
 import time
 
 from abc import abstractmethod
 
-from gym_donkeycar.core.sim_client import SDClient
+from config import (cam_conf, car_conf, client_transport, control_max_rate,
+                    latency_report_interval, latency_stats, racer_conf)
+from control_channel import ControlChannel
+from latency import LatencyStats
+from telemetry import TelemetryPacket
 
-from config import cam_conf, car_conf, racer_conf
+if client_transport == 'asyncio':
+    from async_client import AsyncSDClient as SDClient
+else:
+    from gym_donkeycar.core.sim_client import SDClient
 
 class Client(SDClient):
 
     def __init__(self, address, conf=None, poll_socket_sleep_time=0.01):
+        # set up before connecting; messages can arrive as soon as we do.
+        # subclasses add their own with register_handler
+        self.msg_handlers = {
+            'need_car_config': self.on_need_car_config,
+            'car_loaded': self.on_car_loaded,
+            'collision_with_starting_line': self.on_starting_line,
+            'telemetry': self.on_telemetry_msg,
+        }
+        self.latency = LatencyStats(latency_stats, latency_report_interval)
+        # set by the asyncio transport when a message comes off the socket
+        self.recv_time = None
         super().__init__(*address, poll_socket_sleep_time=poll_socket_sleep_time)
         self.car_loaded = False
         self.reset_car = False
@@ -28,6 +46,8 @@ class Client(SDClient):
         self.fastest_time = None
         self.fastest_laps = 0
         self.hit_count = 0
+        self.controls = ControlChannel(self.send_now, control_max_rate,
+                                       on_sent=self.latency.control_sent)
 
     def config_builder(self, config_dict):
         msg_string = "{"
@@ -36,30 +56,43 @@ class Client(SDClient):
         msg_string += "}"
         return msg_string
 
-    def on_msg_recv(self, json_packet):
+    def register_handler(self, msg_type, handler):
+        self.msg_handlers[msg_type] = handler
 
-        # telemetry will flood the output, starting line is redundant with below checks
-        if json_packet['msg_type'] not in ["telemetry", "collision_with_starting_line"]:
+    def on_msg_recv(self, json_packet):
+        handler = self.msg_handlers.get(json_packet['msg_type'])
+        if handler is None:
             print("got:", json_packet)
-
-        if json_packet['msg_type'] == "need_car_config":
-            print('got config request')
-            self.send_config()
-
-        if json_packet['msg_type'] == "car_loaded":
-            # self.send_config()
-            self.car_loaded = True        
-
-        if json_packet['msg_type'] == "collision_with_starting_line":
-            self.on_finish_line(json_packet['timeStamp'])
-
-        if json_packet['msg_type'] == "telemetry":
-            del json_packet['msg_type']
-            if json_packet['hit'] != 'none':
-                self.hit_count += 1
-                print(f" * hit: {json_packet['hit']} *")
+        else:
+            handler(json_packet)
+
+    def on_need_car_config(self, json_packet):
+        print('got config request')
+        self.send_config()
+
+    def on_car_loaded(self, json_packet):
+        print("got:", json_packet)
+        # self.send_config()
+        self.car_loaded = True
+
+    def on_starting_line(self, json_packet):
+        # starting line is redundant with check_progress, so no print
+        self.on_finish_line(json_packet['timeStamp'])
+
+    def on_telemetry_msg(self, json_packet):
+        now = time.perf_counter()
+        if self.recv_time is not None:
+            self.latency.add('parse', now - self.recv_time)
+            now = self.recv_time
+        json_packet = TelemetryPacket(json_packet)
+        self.latency.frame_received(now, float(json_packet['time']))
+        del json_packet['msg_type']
+        if json_packet['hit'] != 'none':
+            self.hit_count += 1
+            print(f" * hit: {json_packet['hit']} *")
+        with self.latency.stage('on_telemetry'):
             self.on_telemetry(json_packet)
-    
+
     @ abstractmethod
     def on_telemetry(self, json_packet):
         pass
@@ -129,18 +162,15 @@ class Client(SDClient):
         print('config sent!')
 
     def send_controls(self, steering=0.0, throttle=0.0, brake=0.0):
-        p = { "msg_type" : "control",
-                "steering" : steering.__str__(),
-                "throttle" : throttle.__str__(),
-                "brake" : brake.__str__() }
-        msg = json.dumps(p)
-        self.send(msg)
-        #this sleep lets the SDClient thread poll our message and send it out.
-        time.sleep(self.poll_socket_sleep_sec)
+        # never blocks; an unsent older control is replaced by this one
+        self.controls.put(steering, throttle, brake)
 
     def stop(self):
         print(f'Client stopping after {self.current_lap-1} laps.')
+        self.controls.stop()
         super().stop()
+        time_str = time.strftime("%m_%d_%Y/%H_%M_%S")
+        self.latency.dump(f'{os.getcwd()}/../data/latency/{time_str}.json')
 
     @ abstractmethod
     def update(self):
@@ -0,0 +1,106 @@
+# Latency compensation for the autopilot.
+#
+# A control computed from a telemetry frame reaches the sim a while after
+# the frame was taken, and the car has moved on by then. LatencyCompensator
+# keeps a running estimate of that delay (frame sim time -> control written
+# to the socket, less the smallest sim-to-local clock offset seen, plus
+# compensation_extra for the part we can't see) and extrapolates the
+# telemetry the model gets over it. The car is taken to keep its speed and
+# yaw rate in the horizontal plane (Unity: left-handed, y up):
+#   pos_x/z   moved along the velocity, turning at gyro_y as it goes
+#   pos_y     moved along vel_y
+#   vel_x/z   rotated by the yaw turned
+#   yaw       advanced by gyro_y (degrees; gyro is rad/s)
+# Everything else passes through as it came. Steering can also be led by
+# its own rate of change over the same horizon.
+#
+# eval_compensation.py replays a recorded session to check the
+# extrapolation against what the car actually did.
+
+import math
+
+from config import (compensation_extra, compensation_max, compensation_smoothing,
+                    compensation_steering_lead)
+
+
+class LatencyCompensator:
+
+    def __init__(self, extra=compensation_extra, max_latency=compensation_max,
+                 smoothing=compensation_smoothing, steering_lead=compensation_steering_lead):
+        self.extra = extra
+        self.max_latency = max_latency
+        self.smoothing = smoothing
+        self.steering_lead = steering_lead
+        self.clock_offset = None
+        self.latency = None
+        self.samples = 0
+        self.queued_frame = None
+        self.last_steering = None
+
+    def frame_received(self, sim_time, recv_time):
+        offset = recv_time - sim_time
+        if self.clock_offset is None or offset < self.clock_offset:
+            self.clock_offset = offset
+
+    def control_queued(self, frame_time):
+        # the frame behind the control just handed to the control channel;
+        # a newer one replaces it just as the control does
+        self.queued_frame = frame_time
+
+    def control_sent(self, sent_time):
+        if self.queued_frame is None or self.clock_offset is None:
+            return
+        sample = sent_time - self.queued_frame - self.clock_offset
+        self.queued_frame = None
+        if self.latency is None:
+            self.latency = sample
+        else:
+            self.latency += self.smoothing * (sample - self.latency)
+        self.samples += 1
+
+    def horizon(self):
+        # seconds from a frame being taken to its control landing
+        return min((self.latency or 0.0) + self.extra, self.max_latency)
+
+    def extrapolate(self, data):
+        return extrapolate(data, self.horizon())
+
+    def steer(self, steering, frame_time):
+        if not self.steering_lead:
+            return steering
+        last = self.last_steering
+        self.last_steering = (steering, frame_time)
+        if last is None or frame_time <= last[1]:
+            return steering
+        rate = (steering - last[0]) / (frame_time - last[1])
+        steering += self.steering_lead * rate * self.horizon()
+        return max(-1.0, min(1.0, steering))
+
+    def report(self):
+        if self.samples:
+            print(f"latency compensation: {self.latency * 1000:.1f} ms measured over "
+                  f"{self.samples} controls, extrapolating {self.horizon() * 1000:.1f} ms")
+
+
+def extrapolate(data, dt):
+    # the fields of data the state model moves, dt seconds on
+    state = {}
+    if dt <= 0:
+        return state
+    turn = (data.get('gyro_y') or 0.0) * dt
+    if 'vel_x' in data and 'vel_z' in data:
+        vel_x, vel_z = data['vel_x'], data['vel_z']
+        if 'pos_x' in data and 'pos_z' in data:
+            # along the velocity turned halfway: exact for a constant
+            # speed and turn rate to second order in the turn
+            cos, sin = math.cos(turn / 2), math.sin(turn / 2)
+            state['pos_x'] = data['pos_x'] + (vel_x * cos + vel_z * sin) * dt
+            state['pos_z'] = data['pos_z'] + (vel_z * cos - vel_x * sin) * dt
+        cos, sin = math.cos(turn), math.sin(turn)
+        state['vel_x'] = vel_x * cos + vel_z * sin
+        state['vel_z'] = vel_z * cos - vel_x * sin
+    if 'pos_y' in data and 'vel_y' in data:
+        state['pos_y'] = data['pos_y'] + data['vel_y'] * dt
+    if 'yaw' in data and 'gyro_y' in data:
+        state['yaw'] = (data['yaw'] + math.degrees(turn)) % 360.0
+    return state
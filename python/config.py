@@ -1,11 +1,40 @@
 model_history = '/home/grant/projects/vrl/models/model_history.csv'
 model_directory = '/home/grant/projects/vrl/models'
 scaler_directory = '/home/grant/projects/vrl/scalers'
+inference_threads = 0 # CPU threads for the TFLite/ONNX backends, 0 for their default
+inference_warmup = 3 # inferences run on blank inputs when a model loads
+latency_compensation = False # feed the model telemetry extrapolated to when its control lands
+compensation_extra = 0.0 # seconds added to the measured latency (return trip, sim step)
+compensation_max = 0.25 # most seconds the telemetry is extrapolated over
+compensation_smoothing = 0.1 # weight of each new sample in the running latency estimate
+compensation_steering_lead = 0.0 # steering += lead * steering rate * latency, 0 for none
 
-record_format = 'CSV' # None, 'CSV', 'tub' (Donkey Car), 'ASL' (openvslam)
+client_transport = 'asyncio' # 'asyncio', 'SDClient' (gym_donkeycar polling thread)
+control_max_rate = 60 # Hz, 0 for no limit
+latency_stats = True # per-stage timing, dumped to ../data/latency at client stop
+latency_report_interval = 30 # seconds between printed summaries, 0 to disable
+json_backend = 'orjson' # 'orjson' (falls back to 'json' if not installed), 'json'
+record_format = 'CSV' # None, 'CSV', 'tub' (Donkey Car), 'ASL' (openvslam), 'columnar'
 image_format = 'PNG' # 'JPG', 'PNG', 'TGA'
 image_depth = 1 # 1:'grayscale', 3:'rgb'
+record_queue = 64 # frames waiting to be written, 0 to record on the telemetry thread
+record_workers = 2 # threads encoding and writing queued frames
+record_full_policy = 'block' # 'block', or 'drop_oldest' / 'drop_newest' to shed frames instead of stalling telemetry
+flush_interval = 1.0 # seconds between recorder file flushes
+fsync_policy = 'close' # 'never', 'flush' (every flush), 'close'
+tub_catalog = True # tub records in catalog files (Donkey Car tub v2) rather than a JSON file each
+tub_catalog_len = 1000 # records per catalog file
+columnar_block_bytes = 8 * 1024 * 1024 # columnar rows are appended in blocks of about this size
+record_dedup = True # skip frames whose image and telemetry are unchanged (e.g. waiting at the line)
+record_dedup_tolerance = 1e-4 # telemetry values closer than this count as unchanged
+record_interval = 0.0 # minimum sim seconds between recorded frames, 0 to keep every frame
+black_box = False # train mode: keep recent frames in memory, write them only when a trigger fires
+black_box_seconds = 10.0 # sim seconds of frames to hold
+black_box_max_bytes = 64 * 1024 * 1024 # memory cap; the oldest frames go first past it
+black_box_triggers = ('hit', 'reset', 'slow_lap') # events that write the held frames
+black_box_slow_lap = 0.0 # lap time (s) that counts as slow, 0 for no slow_lap trigger
 # telem_type = 'donkey_extended' # 'donkey_basic', 'donkey_extended', 'gym'
+frame_ring_size = 8 # decoded frames kept for the pilot
 trial_laps = 10
 auto_timeout = 35
 
@@ -90,3 +119,20 @@ TELEMETRY_COLUMNS = {
         ]
 }
 
+# numpy dtypes for the columns above when recorded as 'columnar'.
+# anything not listed is float32; (dtype, n) is a fixed-length vector
+TELEMETRY_DTYPES = {
+    'hit': 'U32',
+    'time': 'float64',
+    'activeNode': 'int32',
+    'totalNodes': 'int32',
+    'lap': 'int32',
+    'lap_count': 'int32',
+    'timestep': 'int64',
+    'pos': ('float32', 3),
+    'gyro': ('float32', 3),
+    'accel': ('float32', 3),
+    'vel': ('float32', 3),
+    'car': ('float32', 3),
+    'lidar': ('float32', None), # length depends on the lidar config
+}
@@ -0,0 +1,76 @@
+# Outgoing control messages, latest wins.
+#
+# put() formats the control into a fixed template and hands it to a sender
+# thread without waiting. Only the newest unsent control is kept: anything
+# still pending when a newer one arrives is merged into it (and counted), so
+# stale controls never queue up behind each other. The sender writes at most
+# max_rate messages a second since the sim struggles when flooded.
+
+import threading
+import time
+
+CONTROL_TEMPLATE = '{"msg_type":"control","steering":"%s","throttle":"%s","brake":"%s"}'
+
+
+class ControlChannel:
+
+    def __init__(self, send, max_rate=0, on_sent=None):
+        self.send = send
+        self.on_sent = on_sent
+        self.min_interval = 1.0 / max_rate if max_rate else 0.0
+        self.pending = None
+        self.last_sent = 0.0
+        self.queued = 0
+        self.sent = 0
+        self.merged = 0
+        self.running = True
+        self.cond = threading.Condition()
+        self.th = threading.Thread(target=self.run, daemon=True)
+        self.th.start()
+
+    def put(self, steering, throttle, brake):
+        msg = CONTROL_TEMPLATE % (steering, throttle, brake)
+        with self.cond:
+            if self.pending is not None:
+                self.merged += 1
+            self.pending = msg
+            self.queued += 1
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.pending is None and self.running:
+                    self.cond.wait()
+                if self.pending is None:
+                    return
+                wait = self.last_sent + self.min_interval - time.perf_counter()
+                if wait > 0 and self.running:
+                    # newer controls arriving meanwhile replace this one
+                    self.cond.wait(wait)
+                    continue
+                msg = self.pending
+                self.pending = None
+            self.write(msg)
+
+    def write(self, msg):
+        try:
+            self.send(msg)
+        except OSError as e:
+            print(f"control send failed: {e}")
+            return
+        self.last_sent = time.perf_counter()
+        self.sent += 1
+        if self.on_sent is not None:
+            self.on_sent(self.last_sent)
+
+    def stop(self):
+        # sends whatever is still pending before returning
+        with self.cond:
+            if not self.running:
+                return
+            self.running = False
+            self.cond.notify()
+        self.th.join()
+        print(f"controls: {self.queued} queued, {self.sent} sent, "
+              f"{self.merged} merged into newer ones")
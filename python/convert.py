@@ -0,0 +1,307 @@
+# Converts recorded sessions between the CSV, tub and ASL formats.
+#
+#   python convert.py ../data/06_01_2022/12_00_00 --to tub
+#
+# Sources are read one record at a time. Images are read and transcoded to
+# the output's image_format and image_depth on a process pool, a window of
+# records ahead of the writer, and then written by the usual recorder
+# classes (images that already match take ImageWriter's fast path). Every
+# --checkpoint records the output is synced and <output>/convert.json
+# updated, so rerunning an interrupted conversion picks up from its last
+# checkpoint. ASL output always starts a new DSnn directory and isn't
+# resumed.
+
+import argparse
+import csv
+import json
+import os
+import time
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from itertools import islice
+
+import numpy as np
+
+import config
+from sim_recorder import (PIL_FORMATS, ASLRecorder, CSVRecorder, ImageWriter, TubCatalog,
+                          TubRecorder)
+from telemetry import Frame, TelemetryPacket
+
+FORMATS = ('CSV', 'tub', 'ASL')
+PROGRESS_FILE = 'convert.json'
+IMU_FIELDS = ('gyro_x', 'gyro_y', 'gyro_z', 'accel_x', 'accel_y', 'accel_z')
+
+
+def session_format(session_dir):
+    if os.path.isfile(f'{session_dir}/data.csv'):
+        return 'CSV'
+    if os.path.isfile(f'{session_dir}/manifest.json') or os.path.isdir(f'{session_dir}/tub_data'):
+        return 'tub'
+    if os.path.isfile(f'{session_dir}/mav0/cam0/data.csv'):
+        return 'ASL'
+    raise ValueError(f"no CSV, tub or ASL recording in {session_dir}")
+
+
+def read_session(session_dir):
+    # (fields, image path) per record, in recording order
+    readers = {'CSV': read_csv, 'tub': read_tub, 'ASL': read_asl}
+    return readers[session_format(session_dir)](session_dir)
+
+
+def parse_field(name, text):
+    dtype = config.TELEMETRY_DTYPES.get(name, 'float32')
+    if isinstance(dtype, tuple) or np.dtype(dtype).kind == 'U':
+        return text
+    try:
+        value = float(text)
+    except ValueError:
+        return text
+    return int(value) if np.dtype(dtype).kind in 'iu' else value
+
+
+def read_csv(session_dir):
+    with open(f'{session_dir}/data.csv', newline='') as csv_file:
+        for row in csv.DictReader(csv_file):
+            image_file = row.pop('image')
+            fields = {name: parse_field(name, text) for name, text in row.items()}
+            yield fields, f'{session_dir}/images/{image_file}'
+
+
+def read_tub(session_dir):
+    if os.path.isfile(f'{session_dir}/manifest.json'):
+        catalog = TubCatalog(session_dir)
+        for name in catalog.paths:
+            with open(f'{session_dir}/{name}') as catalog_file:
+                for line in catalog_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # cut off mid-write; nothing after it is complete
+                        print(f"{session_dir}/{name}: stopping at a partial record")
+                        return
+                    if record['_index'] in catalog.deleted_indexes:
+                        continue
+                    image_file = record.pop('image')
+                    fields = {key: value for key, value in record.items()
+                              if not key.startswith('_')}
+                    yield fields, f'{session_dir}/images/{image_file}'
+        return
+    # one data_NNNN JSON file and one frame_NNNN image per record
+    data_dir = f'{session_dir}/tub_data'
+    img_dir = f'{session_dir}/images'
+    image_exts = {image_file.rsplit('.', 1)[-1] for image_file in os.listdir(img_dir)}
+    image_ext = image_exts.pop() if len(image_exts) == 1 else config.image_format.lower()
+    for name in sorted(os.listdir(data_dir), key=lambda name: int(name.split('_')[1])):
+        with open(f'{data_dir}/{name}') as data_file:
+            fields = json.load(data_file)
+        record_num = int(name.split('_')[1])
+        yield fields, f'{img_dir}/frame_{record_num:04d}.{image_ext}'
+
+
+def read_asl(session_dir):
+    cam_dir = f'{session_dir}/mav0/cam0'
+    # both files get one row per frame, written together
+    with open(f'{cam_dir}/data.csv', newline='') as cam_file, \
+         open(f'{session_dir}/mav0/imu0/data.csv', newline='') as imu_file:
+        cam_rows = csv.reader(cam_file)
+        imu_rows = csv.reader(imu_file)
+        next(cam_rows)
+        next(imu_rows)
+        for (time_stamp, image_file), imu in zip(cam_rows, imu_rows):
+            fields = {'time': int(time_stamp) / 1e9}
+            fields.update(zip(IMU_FIELDS, map(float, imu[1:])))
+            yield fields, f'{cam_dir}/data/{image_file}'
+
+
+def transcode(path, image_format, image_depth):
+    # runs in the pool: the image as bytes in the output's format
+    with open(path, 'rb') as image_file:
+        encoded = image_file.read()
+    if ImageWriter(image_format, image_depth).matches(encoded):
+        return encoded
+    image = Frame(encoded).image(image_depth)
+    if image_depth == 3 and image.mode != 'RGB':
+        # grayscale source to an rgb output
+        image = image.convert('RGB')
+    buffer = BytesIO()
+    image.save(buffer, format=PIL_FORMATS[image_format.upper()])
+    return buffer.getvalue()
+
+
+def guess_telem_type(fields):
+    # the telemetry type with the most of these fields
+    return max(config.TELEMETRY_COLUMNS,
+               key=lambda telem_type: sum(col in fields
+                                          for col in config.TELEMETRY_COLUMNS[telem_type]))
+
+
+class Converter:
+
+    def __init__(self, session_dir, out_format, out_dir, image_format, image_depth,
+                 telem_type=None):
+        self.session_dir = session_dir
+        self.out_format = out_format
+        self.out_dir = out_dir
+        self.image_format = image_format
+        self.image_depth = image_depth
+        self.telem_type = telem_type
+        self.progress_path = f'{out_dir}/{PROGRESS_FILE}'
+        self.progress = {'source': session_dir, 'format': out_format, 'source_rows': 0,
+                         'rows': 0, 'data_bytes': 0, 'done': False}
+        self.recorder = None
+        self.skipped = 0
+
+    def load_progress(self):
+        if self.out_format != 'ASL' and os.path.isfile(self.progress_path):
+            with open(self.progress_path) as progress_file:
+                self.progress = json.load(progress_file)
+        return self.progress
+
+    def save_progress(self):
+        with open(self.progress_path + '.tmp', 'w') as progress_file:
+            json.dump(self.progress, progress_file, indent=2)
+        os.replace(self.progress_path + '.tmp', self.progress_path)
+
+    def open_recorder(self, first_fields):
+        if self.out_format == 'ASL':
+            self.recorder = ASLRecorder(self.image_format, self.image_depth)
+            return
+        resuming = os.path.isfile(self.progress_path)
+        os.makedirs(self.out_dir, exist_ok=True)
+        if not resuming:
+            # written first, so even a run stopped before its first
+            # checkpoint resumes from the start rather than appending
+            self.save_progress()
+        if self.out_format == 'CSV':
+            conf = {}
+            if os.path.isfile(f'{self.session_dir}/conf'):
+                with open(f'{self.session_dir}/conf') as conf_file:
+                    conf = json.load(conf_file)
+            conf['telem_type'] = (self.telem_type or conf.get('telem_type')
+                                  or guess_telem_type(first_fields))
+            conf['image_format'] = self.image_format
+            conf['image_depth'] = self.image_depth
+            if os.path.isfile(f'{self.out_dir}/data.csv'):
+                # drop rows written after the last checkpoint
+                with open(f'{self.out_dir}/data.csv', 'r+b') as csv_file:
+                    csv_file.truncate(self.progress['data_bytes'])
+            self.recorder = CSVRecorder(conf, self.out_dir)
+            missing = [col for col in self.recorder.telem_cols
+                       if col != 'image' and col not in first_fields]
+            if missing:
+                print(f"{self.session_dir} has no {missing}; left empty")
+        else:
+            if resuming and config.tub_catalog:
+                TubCatalog(self.out_dir, config.tub_catalog_len).truncate(self.progress['rows'])
+            elif resuming:
+                data_dir = f'{self.out_dir}/tub_data'
+                for name in os.listdir(data_dir) if os.path.isdir(data_dir) else []:
+                    if int(name.split('_')[1]) >= self.progress['rows']:
+                        os.remove(f'{data_dir}/{name}')
+            self.recorder = TubRecorder(self.image_format, self.image_depth, self.out_dir)
+
+    def checkpoint(self):
+        if self.out_format == 'ASL':
+            return
+        if self.out_format == 'CSV':
+            self.progress['data_bytes'] = self.recorder.rows.sync()
+        else:
+            self.recorder.flush()
+        self.save_progress()
+
+    def write(self, fields, future, checkpoint):
+        self.progress['source_rows'] += 1
+        try:
+            encoded = future.result()
+        except (OSError, ValueError) as e:
+            print(f"skipping record {self.progress['source_rows'] - 1}: {e}")
+            self.skipped += 1
+            return
+        if self.out_format == 'CSV':
+            for col in self.recorder.telem_cols:
+                fields.setdefault(col, None)
+        self.recorder.record(TelemetryPacket.from_encoded(fields, encoded))
+        self.progress['rows'] += 1
+        if self.progress['rows'] % checkpoint == 0:
+            self.checkpoint()
+
+    def run(self, pool, window, checkpoint):
+        start = time.perf_counter()
+        records = islice(read_session(self.session_dir), self.progress['source_rows'], None)
+        pending = deque()
+        for fields, image_path in records:
+            if self.recorder is None:
+                self.open_recorder(fields)
+            future = pool.submit(transcode, image_path, self.image_format, self.image_depth)
+            pending.append((fields, future))
+            if len(pending) >= window:
+                self.write(*pending.popleft(), checkpoint)
+        while pending:
+            self.write(*pending.popleft(), checkpoint)
+        if self.recorder is None:
+            print(f"{self.session_dir}: nothing to convert")
+            return
+        self.recorder.close()
+        if self.out_format != 'ASL':
+            if self.out_format == 'CSV':
+                self.progress['data_bytes'] = os.path.getsize(f'{self.out_dir}/data.csv')
+            self.progress['done'] = True
+            self.save_progress()
+        elapsed = time.perf_counter() - start
+        print(f"{self.session_dir} -> {self.recorder.dir}: {self.progress['rows']} records "
+              f"({self.skipped} skipped) in {elapsed:.1f}s")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="convert recordings between formats")
+    parser.add_argument("sessions",
+                        nargs='+',
+                        help="session directories (CSV, tub or ASL)",)
+    parser.add_argument("--to",
+                        choices=FORMATS,
+                        required=True,
+                        help="output format",)
+    parser.add_argument("--out",
+                        type=str,
+                        default=None,
+                        help="directory to put converted sessions in (default: next to each source)",)
+    parser.add_argument("--image_format",
+                        type=str,
+                        default=config.image_format,
+                        help="output image format",)
+    parser.add_argument("--image_depth",
+                        type=int,
+                        default=config.image_depth,
+                        help="output image depth, 1 or 3",)
+    parser.add_argument("--telem_type",
+                        choices=list(config.TELEMETRY_COLUMNS),
+                        default=None,
+                        help="CSV columns (default: the source's, or the closest match)",)
+    parser.add_argument("--workers",
+                        type=int,
+                        default=os.cpu_count(),
+                        help="image transcoding processes",)
+    parser.add_argument("--checkpoint",
+                        type=int,
+                        default=500,
+                        help="records between resume checkpoints",)
+
+    args = parser.parse_args()
+    with ProcessPoolExecutor(args.workers) as pool:
+        for session_dir in args.sessions:
+            session_dir = session_dir.rstrip('/')
+            name = f'{os.path.basename(session_dir)}_{args.to}'
+            out_dir = (f'{args.out}/{name}' if args.out
+                       else f'{os.path.dirname(session_dir)}/{name}')
+            converter = Converter(session_dir, args.to, out_dir, args.image_format,
+                                  args.image_depth, args.telem_type)
+            progress = converter.load_progress()
+            if progress['done']:
+                print(f"{session_dir} already converted to {out_dir}")
+                continue
+            if progress['source_rows']:
+                print(f"resuming {session_dir} after {progress['source_rows']} records")
+            converter.run(pool, args.workers * 8, args.checkpoint)
@@ -0,0 +1,278 @@
+# Training data from recorded sessions.
+#
+# SessionDataset opens one or more session directories and serves shuffled
+# numpy batches of images and telemetry columns. The first time a
+# CSVRecorder session is opened its images are decoded and its data.csv
+# parsed into a ColumnStore under <session>/cache; after that the session is
+# only memory-mapped, so later runs and epochs open no PNGs at all.
+# Columnar sessions (record_format = 'columnar') are mapped directly.
+#
+#   data = SessionDataset.for_model(['../data/06_01_2022/12_00_00'], 42,
+#                                   targets=['steering_angle', 'throttle'])
+#   for images, telemetry, targets in data.batches(64):
+#       ...
+#
+# SessionIndex reads a session's index.json (sim_recorder.EventIndex) and
+# gives row ranges for laps and collisions. Pass select to use only those:
+#
+#   SessionDataset(dirs, columns, select=lambda index: index.laps(clean=True))
+
+import csv
+import json
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import config
+from sim_recorder import ColumnStore, EventIndex, TubCatalog, load_columnar
+from telemetry import Frame
+
+CACHE_DIR = 'cache'
+
+
+class SessionDataset:
+
+    def __init__(self, session_dirs, columns, targets=None, image_depth=None,
+                 image_dtype='float32', rebuild=False, select=None):
+        if isinstance(session_dirs, str):
+            session_dirs = [session_dirs]
+        self.columns = list(columns)
+        self.targets = list(targets) if targets else []
+        self.image_depth = image_depth or config.image_depth
+        self.image_dtype = image_dtype
+        self.sessions = [open_session(session_dir, self.image_depth, rebuild)
+                         for session_dir in session_dirs]
+        # session rows in use, in order
+        self.rows = []
+        for session_dir, session in zip(session_dirs, self.sessions):
+            rows = np.arange(len(session['image']))
+            if select is not None:
+                rows = rows[ranges_mask(select(SessionIndex(session_dir)), len(rows))]
+            self.rows.append(rows)
+        lengths = [len(rows) for rows in self.rows]
+        # global index i lives in session searchsorted(ends, i, 'right')
+        self.ends = np.cumsum(lengths)
+        self.starts = self.ends - lengths
+        self.image_shape = self.sessions[0]['image'].shape[1:]
+        for session_dir, session in zip(session_dirs, self.sessions):
+            missing = [col for col in self.columns + self.targets
+                       if col not in session and col != 'first_lap']
+            if missing:
+                raise KeyError(f"{session_dir} has no column(s) {missing}")
+
+    @classmethod
+    def for_model(cls, session_dirs, model_number, **kwargs):
+        # the columns the model was trained with, from model_history
+        from pilot import model_paths
+        data = model_paths(config.model_history, model_number)
+        return cls(session_dirs, data['telemetry_columns'], **kwargs)
+
+    def __len__(self):
+        return int(self.ends[-1]) if len(self.ends) else 0
+
+    def column(self, session, name):
+        if name == 'first_lap' and name not in session:
+            # added by AutoClient at drive time rather than recorded
+            return session['lap'] == 1
+        return session[name]
+
+    def batches(self, batch_size=64, shuffle=True, seed=None, drop_last=False):
+        order = np.arange(len(self))
+        if shuffle:
+            np.random.default_rng(seed).shuffle(order)
+        stop = len(order) - len(order) % batch_size if drop_last else len(order)
+        for start in range(0, stop, batch_size):
+            yield self.gather(order[start:start + batch_size])
+
+    def gather(self, indexes):
+        # memmaps read fastest in file order, so sort within the batch
+        indexes = np.sort(indexes)
+        n = len(indexes)
+        images = np.empty((n,) + self.image_shape, dtype=self.image_dtype)
+        telemetry = np.empty((n, len(self.columns)), dtype='float32')
+        targets = np.empty((n, len(self.targets)), dtype='float32')
+        owners = np.searchsorted(self.ends, indexes, side='right')
+        for owner in np.unique(owners):
+            rows = owners == owner
+            local = self.rows[owner][indexes[rows] - self.starts[owner]]
+            session = self.sessions[owner]
+            images[rows] = session['image'][local]
+            for i, col in enumerate(self.columns):
+                telemetry[rows, i] = self.column(session, col)[local]
+            for i, col in enumerate(self.targets):
+                targets[rows, i] = self.column(session, col)[local]
+        if self.targets:
+            return images, telemetry, targets
+        return images, telemetry
+
+
+def open_session(session_dir, image_depth, rebuild=False):
+    if os.path.isfile(f'{session_dir}/schema.json'):
+        return load_columnar(session_dir)
+    cache_dir = f'{session_dir}/{CACHE_DIR}'
+    if rebuild or not cache_valid(session_dir, cache_dir, image_depth):
+        build_cache(session_dir, cache_dir, image_depth)
+    return load_columnar(cache_dir)
+
+
+def cache_valid(session_dir, cache_dir, image_depth):
+    # stale once data.csv changes size, e.g. a resumed session grew
+    try:
+        with open(f'{cache_dir}/built') as built_file:
+            built = json.load(built_file)
+        return (built['image_depth'] == image_depth
+                and built['data_bytes'] == os.path.getsize(f'{session_dir}/data.csv'))
+    except (OSError, ValueError, KeyError):
+        return False
+
+
+def build_cache(session_dir, cache_dir, image_depth):
+    print(f"building cache for {session_dir}")
+    if os.path.isfile(f'{cache_dir}/built'):
+        os.remove(f'{cache_dir}/built')
+    data_bytes = os.path.getsize(f'{session_dir}/data.csv')
+    with open(f'{session_dir}/data.csv', newline='') as csv_file:
+        rows = list(csv.DictReader(csv_file))
+    if not rows:
+        raise ValueError(f"{session_dir}/data.csv has no rows")
+    names = [name for name in rows[0] if name != 'image']
+
+    def load_image(row):
+        with open(f"{session_dir}/images/{row['image']}", 'rb') as image_file:
+            return Frame(image_file.read()).view(image_depth)
+
+    columns = []
+    for name in names:
+        dtype = config.TELEMETRY_DTYPES.get(name, 'float32')
+        # vectors (gym fields) aren't in CSV sessions; skip rather than guess
+        if not isinstance(dtype, tuple):
+            columns.append((name, dtype, ()))
+    numeric = [name for name, dtype, _ in columns if np.dtype(dtype).kind in 'biuf']
+
+    store = None
+    with ThreadPoolExecutor() as pool:
+        # a chunk at a time so decoded images don't pile up in memory
+        for chunk_start in range(0, len(rows), 1024):
+            chunk = rows[chunk_start:chunk_start + 1024]
+            for row, pixels in zip(chunk, pool.map(load_image, chunk)):
+                if store is None:
+                    store = ColumnStore(cache_dir, [('image', 'uint8', pixels.shape)] + columns,
+                                        config.columnar_block_bytes)
+                for name in numeric:
+                    # csv gives strings; '3.0' won't cast to an int column directly
+                    row[name] = float(row[name])
+                row['image'] = pixels
+                store.append(row)
+    store.close()
+    with open(f'{cache_dir}/built', 'w') as built_file:
+        json.dump({'image_depth': image_depth, 'rows': store.rows, 'data_bytes': data_bytes},
+                  built_file)
+
+
+class SessionIndex:
+
+    # Row ranges from a session's index.json. A session recorded before
+    # the index existed is scanned once and its index written; lap times
+    # only come from the client though, so a rebuilt index has none.
+
+    def __init__(self, session_dir):
+        path = f'{session_dir}/index.json'
+        if not os.path.isfile(path):
+            build_index(session_dir)
+        with open(path) as index_file:
+            index = json.load(index_file)
+        self.rows = index['rows']
+        self.lap_entries = index['laps']
+        self.hit_entries = index['hits']
+        self.nodes = index['nodes']
+
+    def laps(self, clean=False, timed=True, max_time=None):
+        # (start, stop) of each lap; timed leaves out laps the client didn't
+        # time (the partial ones), clean the ones with a hit
+        ranges = []
+        for lap in self.lap_entries:
+            if timed and lap['time'] is None:
+                continue
+            if clean and lap['hits']:
+                continue
+            if max_time is not None and (lap['time'] is None or lap['time'] > max_time):
+                continue
+            ranges.append((lap['start'], lap['stop']))
+        return ranges
+
+    def lap_times(self):
+        # {(segment, lap): time}; lap numbers restart in each segment
+        return {(lap.get('segment', 0), lap['lap']): lap['time']
+                for lap in self.lap_entries if lap['time'] is not None}
+
+    def around_hits(self, before=20, after=20, hit=None):
+        # each run of hit frames widened by before/after rows, overlaps merged
+        ranges = []
+        for entry in self.hit_entries:
+            if hit is not None and entry['hit'] != hit:
+                continue
+            start = max(0, entry['start'] - before)
+            stop = min(self.rows, entry['stop'] + after)
+            if ranges and start <= ranges[-1][1]:
+                ranges[-1] = (ranges[-1][0], max(stop, ranges[-1][1]))
+            else:
+                ranges.append((start, stop))
+        return ranges
+
+    def node_ranges(self, first, last):
+        # rows while activeNode is within first..last
+        ranges = []
+        stops = [row for row, _ in self.nodes[1:]] + [self.rows]
+        for (start, node), stop in zip(self.nodes, stops):
+            if first <= node <= last:
+                if ranges and ranges[-1][1] == start:
+                    ranges[-1] = (ranges[-1][0], stop)
+                else:
+                    ranges.append((start, stop))
+        return ranges
+
+
+def ranges_mask(ranges, rows):
+    mask = np.zeros(rows, dtype=bool)
+    for start, stop in ranges:
+        mask[start:stop] = True
+    return mask
+
+
+INDEX_FIELDS = ('lap', 'hit', 'activeNode', 'time')
+
+
+def build_index(session_dir):
+    print(f"indexing {session_dir}")
+    index = EventIndex(session_dir)
+    for row, record in enumerate(scan_records(session_dir)):
+        index.add(row, record)
+    index.close()
+
+
+def scan_records(session_dir):
+    # just the fields the index needs, in row order
+    if os.path.isfile(f'{session_dir}/schema.json'):
+        columns = load_columnar(session_dir)
+        names = [name for name in INDEX_FIELDS if name in columns]
+        for values in zip(*(columns[name].tolist() for name in names)):
+            yield dict(zip(names, values))
+    elif os.path.isfile(f'{session_dir}/data.csv'):
+        with open(f'{session_dir}/data.csv', newline='') as csv_file:
+            for row in csv.DictReader(csv_file):
+                yield {
+                    'lap': int(float(row['lap'])) if 'lap' in row else None,
+                    'hit': row.get('hit', 'none'),
+                    'activeNode': int(float(row['activeNode'])) if 'activeNode' in row else None,
+                    'time': float(row['time']) if 'time' in row else None,
+                }
+    elif os.path.isfile(f'{session_dir}/manifest.json'):
+        catalog = TubCatalog(session_dir)
+        for index in range(catalog.current_index):
+            record = catalog.read(index)
+            # deleted records keep their row; they just carry no events
+            yield {} if record is None else {name: record.get(name) for name in INDEX_FIELDS}
+    else:
+        raise ValueError(f"no recording found in {session_dir}")
@@ -0,0 +1,153 @@
+# Replays a recorded CSV session to see how well latency compensation
+# predicts the car's state.
+#
+#   python eval_compensation.py ../data/06_01_2022/12_00_00 --latency 50 100 150
+#
+# For each latency every frame's telemetry is extrapolated (compensation.py)
+# to the recorded frame closest to that much later, and compared with what
+# the car actually did there; the baseline is the uncompensated frame, as
+# the model gets it now. Pairs spanning a reset or a gap in the recording
+# are left out. With --model_number the pilot is also run on sampled
+# frames: its controls from the raw and the extrapolated telemetry are
+# compared with the controls it gives on the later frame itself.
+
+import argparse
+import json
+import math
+
+import numpy as np
+from PIL import Image
+
+from compensation import extrapolate
+from convert import read_csv
+
+# frames further apart than this (s) start a new stretch of driving
+MAX_GAP = 0.5
+
+
+def load_session(session_dir):
+    frames = list(read_csv(session_dir))
+    times = np.array([fields['time'] for fields, _ in frames], dtype=np.float64)
+    # sim time restarts (or jumps) on a reset
+    steps = np.diff(times)
+    stretch = np.concatenate([[0], np.cumsum((steps <= 0) | (steps > MAX_GAP))])
+    return frames, times, stretch
+
+
+def pairs(times, stretch, latency):
+    # (i, j): frame j is the one in frame i's stretch closest to latency
+    # after it. Time only increases within a stretch, so each is searched
+    # on its own
+    i_all, j_all = [], []
+    starts = np.flatnonzero(np.diff(stretch, prepend=-1))
+    for start, end in zip(starts, list(starts[1:]) + [len(times)]):
+        t = times[start:end]
+        j = np.minimum(np.searchsorted(t, t + latency), len(t) - 1)
+        earlier = np.maximum(j - 1, 0)
+        j = np.where(np.abs(t[earlier] - t - latency) < np.abs(t[j] - t - latency), earlier, j)
+        i = np.arange(len(t))
+        keep = j > i
+        i_all.append(start + i[keep])
+        j_all.append(start + j[keep])
+    if not i_all:
+        return np.array([], dtype=int), np.array([], dtype=int)
+    return np.concatenate(i_all), np.concatenate(j_all)
+
+
+def state_errors(now, later):
+    # position, velocity and yaw errors of the state now against later
+    errors = {}
+    if all(col in now for col in ('pos_x', 'pos_z')):
+        errors['pos'] = math.hypot(now['pos_x'] - later['pos_x'], now['pos_z'] - later['pos_z'])
+    if all(col in now for col in ('vel_x', 'vel_z')):
+        errors['vel'] = math.hypot(now['vel_x'] - later['vel_x'], now['vel_z'] - later['vel_z'])
+    if 'yaw' in now:
+        errors['yaw'] = abs((now['yaw'] - later['yaw'] + 180.0) % 360.0 - 180.0)
+    return errors
+
+
+def summarize(errors):
+    errors = np.asarray(errors)
+    return f"{errors.mean():8.4f} {np.percentile(errors, 95):8.4f}"
+
+
+def evaluate_state(frames, times, stretch, latency):
+    baseline, compensated = {}, {}
+    for i, j in zip(*pairs(times, stretch, latency)):
+        now, later = frames[i][0], frames[j][0]
+        predicted = dict(now)
+        predicted.update(extrapolate(now, times[j] - times[i]))
+        for name, error in state_errors(now, later).items():
+            baseline.setdefault(name, []).append(error)
+        for name, error in state_errors(predicted, later).items():
+            compensated.setdefault(name, []).append(error)
+    return baseline, compensated
+
+
+def load_image(path, depth):
+    with Image.open(path) as image:
+        return np.asarray(image.convert('L' if depth == 1 else 'RGB'))
+
+
+def evaluate_pilot(pilot, frames, times, stretch, latency, every, depth):
+    errors = {'baseline': [], 'compensated': []}
+    i_all, j_all = pairs(times, stretch, latency)
+    for i, j in zip(i_all[::every], j_all[::every]):
+        (now, image_path), (later, later_path) = frames[i], frames[j]
+        predicted = dict(now)
+        predicted.update(extrapolate(now, times[j] - times[i]))
+        image = load_image(image_path, depth)
+        target = np.array(pilot.infer((load_image(later_path, depth),
+                                       [later[col] for col in pilot.telemetry_columns])))
+        for name, fields in (('baseline', now), ('compensated', predicted)):
+            controls = pilot.infer((image, [fields[col] for col in pilot.telemetry_columns]))
+            errors[name].append(np.abs(np.array(controls) - target))
+    return {name: np.array(values) for name, values in errors.items()}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="replay a session to evaluate latency compensation")
+    parser.add_argument("session",
+                        type=str,
+                        help="CSV session directory",)
+    parser.add_argument("--latency",
+                        type=float,
+                        nargs='+',
+                        default=[50, 100, 150, 200],
+                        help="latencies to extrapolate over, ms",)
+    parser.add_argument("--model_number",
+                        type=int,
+                        default=None,
+                        help="also compare the pilot's controls",)
+    parser.add_argument("--every",
+                        type=int,
+                        default=10,
+                        help="run the pilot on every nth frame pair",)
+
+    args = parser.parse_args()
+    frames, times, stretch = load_session(args.session.rstrip('/'))
+    print(f"{len(frames)} frames, {stretch[-1] + 1 if len(frames) else 0} stretches")
+    pilot = None
+    if args.model_number is not None:
+        from pilot import Autopilot
+        with open(f"{args.session.rstrip('/')}/conf") as conf_file:
+            depth = json.load(conf_file).get('image_depth', 1)
+        pilot = Autopilot({'model_number': args.model_number})
+
+    for latency in args.latency:
+        baseline, compensated = evaluate_state(frames, times, stretch, latency / 1000)
+        print(f"\n{latency:.0f} ms: {len(next(iter(baseline.values()), []))} frame pairs"
+              f"{'' if baseline else ', no pos/vel/yaw columns'}")
+        if baseline:
+            print(f"  {'error':>5}  {'baseline mean/p95':>17}  {'compensated mean/p95':>20}")
+        for name in baseline:
+            print(f"  {name:>5}  {summarize(baseline[name])}  {summarize(compensated[name]):>20}")
+        if pilot is not None:
+            errors = evaluate_pilot(pilot, frames, times, stretch, latency / 1000,
+                                    args.every, depth)
+            for name, values in errors.items():
+                if len(values):
+                    mean = values.mean(axis=0)
+                    print(f"  pilot {name:>11}: steering {mean[0]:.4f} throttle {mean[1]:.4f} "
+                          f"brake {mean[2]:.4f} ({len(values)} frames)")
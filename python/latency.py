@@ -0,0 +1,174 @@
+# Per-stage timing for the telemetry -> control loop.
+#
+# Each stage (parse, decode, infer, record, ...) feeds two fixed-bucket
+# histograms: one for the current report window and one for the whole
+# session. Adding a sample is a bisect and a few increments, so this stays
+# on during normal driving. Frame-level timings tie the newest telemetry
+# frame to the first control sent after it:
+#   frame_to_control  local receive time -> control written to the socket
+#   sim_to_control    sim 'time' -> control written, less the smallest
+#                     sim-to-local clock offset seen (so it includes transit
+#                     delay beyond the best case)
+
+import json
+import os
+import time
+
+from bisect import bisect_left
+
+# 1 us to 100 s, 20 buckets per decade (~12% resolution)
+BOUNDS = [1e-6 * 10 ** (i / 20) for i in range(161)]
+
+
+class Histogram:
+
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect_left(BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        target = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= target and count:
+                return min(BOUNDS[i], self.max) if i < len(BOUNDS) else self.max
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return None
+        return {
+            'count': self.count,
+            'mean_ms': round(self.total / self.count * 1000, 3),
+            'p50_ms': round(self.percentile(0.50) * 1000, 3),
+            'p95_ms': round(self.percentile(0.95) * 1000, 3),
+            'p99_ms': round(self.percentile(0.99) * 1000, 3),
+            'max_ms': round(self.max * 1000, 3),
+        }
+
+
+class StageTimer:
+
+    __slots__ = ('stats', 'name', 'start')
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.stats.add(self.name, time.perf_counter() - self.start)
+
+
+class NullTimer:
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class LatencyStats:
+
+    def __init__(self, enabled=True, report_interval=0.0):
+        self.enabled = enabled
+        self.report_interval = report_interval
+        self.stages = {} # name -> (window histogram, session histogram)
+        self.timers = {}
+        self.frames = 0
+        self.window_frames = 0
+        self.start = time.perf_counter()
+        self.last_report = self.start
+        self.frame_time = None
+        self.frame_sim_time = None
+        self.frame_answered = True
+        self.clock_offset = None
+        self.dumped = False
+
+    def stage(self, name):
+        # one timer per stage; each stage only ever runs on one thread
+        if not self.enabled:
+            return NULL_TIMER
+        timer = self.timers.get(name)
+        if timer is None:
+            timer = self.timers[name] = StageTimer(self, name)
+        return timer
+
+    def add(self, name, seconds):
+        if not self.enabled:
+            return
+        hists = self.stages.get(name)
+        if hists is None:
+            hists = self.stages[name] = (Histogram(), Histogram())
+        hists[0].add(seconds)
+        hists[1].add(seconds)
+
+    def frame_received(self, recv_time, sim_time):
+        if not self.enabled:
+            return
+        self.frames += 1
+        self.window_frames += 1
+        self.frame_time = recv_time
+        self.frame_sim_time = sim_time
+        self.frame_answered = False
+        offset = recv_time - sim_time
+        if self.clock_offset is None or offset < self.clock_offset:
+            self.clock_offset = offset
+        if self.report_interval and recv_time - self.last_report >= self.report_interval:
+            self.report(recv_time)
+
+    def control_sent(self, sent_time):
+        if not self.enabled or self.frame_answered or self.frame_time is None:
+            return
+        self.frame_answered = True
+        self.add('frame_to_control', sent_time - self.frame_time)
+        self.add('sim_to_control', sent_time - self.frame_sim_time - self.clock_offset)
+
+    def report(self, now):
+        elapsed = now - self.last_report
+        print(f"latency, last {elapsed:.0f}s ({self.window_frames} frames, "
+              f"{self.window_frames / elapsed:.1f} fps) p50/p95/p99 ms:")
+        stages = list(self.stages.items())
+        for name, (window, _) in stages:
+            if window.count:
+                print(f"  {name:>16}: {window.percentile(0.50) * 1000:7.2f} "
+                      f"{window.percentile(0.95) * 1000:7.2f} "
+                      f"{window.percentile(0.99) * 1000:7.2f}")
+        for name, (_, session) in stages:
+            self.stages[name] = (Histogram(), session)
+        self.window_frames = 0
+        self.last_report = now
+
+    def summary(self):
+        return {
+            'frames': self.frames,
+            'seconds': round(time.perf_counter() - self.start, 3),
+            'stages': {name: hists[1].summary() for name, hists in self.stages.items()},
+        }
+
+    def dump(self, path):
+        if not self.enabled or not self.frames or self.dumped:
+            return
+        self.dumped = True
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as dump_file:
+            json.dump(self.summary(), dump_file, indent=2)
+        print(f"LATENCY FILE: {path}")
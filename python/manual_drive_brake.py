@@ -23,7 +23,8 @@ class ManualBrakeClient(Client):
         self.check_progress(data)
         data['brake'] = self.braking
         data['lap'] = self.current_lap
-        self.recorder.record(data)
+        with self.latency.stage('record'):
+            self.recorder.record(data)
 
     def update(self):
         steering, throttle, brake = 0.0, 0.0, 0.0
@@ -91,6 +92,14 @@ class ManualBrakeClient(Client):
                 print('Driving stopped')
                 self.driving = False
 
+    def stop(self):
+        super().stop()
+        self.recorder.close()
+
+    def on_full_lap(self, lap_time):
+        super().on_full_lap(lap_time)
+        self.recorder.mark_lap(self.current_lap, lap_time)
+
     def update_controller(self):
         try:
             self.ctr.update()
@@ -169,6 +178,10 @@ if __name__ == "__main__":
                         default="sparkfun_avc",
                         help="name of donkey sim environment", 
                         choices=track_list,)
+    parser.add_argument("--session",
+                        type=str,
+                        default=None,
+                        help="CSV session directory to resume, e.g. after a crash",)
 
     args = parser.parse_args()
     conf = {
@@ -180,6 +193,8 @@ if __name__ == "__main__":
         "image_depth": 1, # 1:'grayscale', 3:'rgb'
         "telem_type": 'donkey_extended_brake' # 'donkey_basic', 'donkey_extended', 'donkey_extended_brake', 'gym'
     }
+    # set by the first recorder when None, so every reset records into one session
+    conf['session_dir'] = args.session
 
     while True: 
         refresh = run_client(conf)
@@ -1,67 +1,422 @@
 # Used as controller for donkey client. Takes image and makes predictions
 # of steering and throttle with its model.
+#
+# The model runs on one of three backends, picked per model from the
+# 'backend' column of the model history, or else from the file extension:
+#   keras   the saved Keras model (.h5 / SavedModel), called eagerly
+#   tflite  a converted .tflite model, on tflite_runtime if installed,
+#           otherwise TensorFlow's interpreter
+#   onnx    an .onnx model on ONNX Runtime's CPU provider
+# Each backend takes the image and telemetry batches and returns the
+# model's outputs as a list of numpy arrays.
+#
+# The optional 'outputs' column of the model history says how those map to
+# controls:
+#   steering  (the default) a single output is steering, driven with
+#             throttle 1 and brake 0; separate heads are steering and
+#             throttle, brake 0
+#   controls  steering, throttle[, brake], whether from separate heads or
+#             the values of a single output
+#
+# Inputs go through a Preprocessor built at load time: the telemetry
+# scaler reduced to a float32 multiply-add, and frames cast into a reused
+# batch-of-one buffer only when they aren't already in the model's dtype.
+#
+# Models and scalers come from a ModelRegistry, which keeps them loaded
+# for the life of the process. TensorFlow is only imported when a Keras
+# model (or TFLite without tflite_runtime) is first loaded.
+import ast
 import csv
+import os
+import threading
+import time
 # import numpy as n
 
-from numpy import array, asfarray
+import numpy as np
+from numpy import asarray
 from pickle import load
-from tensorflow.keras.models import load_model
 
 
-from config import model_directory, model_history, scaler_directory
+from config import (inference_threads, inference_warmup, model_directory, model_history,
+                    scaler_directory)
+
+BACKENDS = ('keras', 'tflite', 'onnx')
+OUTPUTS = ('steering', 'controls')
+
+# ONNX Runtime's input types
+ONNX_DTYPES = {'tensor(float)': 'float32', 'tensor(float16)': 'float16',
+               'tensor(double)': 'float64', 'tensor(uint8)': 'uint8'}
 
 class Autopilot:
 
     def __init__(self, conf):
-        data = model_paths(model_history, conf['model_number'])
-        self.model = load_model(f"{model_directory}/{data['model_file']}", compile=False)
+        models = registry()
+        data = models.entry(conf['model_number'])
+        self.backend = models.backend(data)
         if data['scaler_file']:
-            self.scaler = load(open(f"{scaler_directory}/{data['scaler_file']}", 'rb'))
-            print(f"{data['scaler_file'] = }")
+            self.scaler = models.scaler(data['scaler_file'])
         else:
             self.scaler = None
         self.telemetry_columns = data['telemetry_columns']
+        self.outputs = data['outputs']
+        # let the client hand us frames already in this dtype
+        self.image_dtype = self.backend.image_dtype
+        self.preprocess = Preprocessor(self.backend, self.scaler, len(self.telemetry_columns))
 
 
     def infer(self, inputs):
         # return 0.0, 1.0, 0.0
-        img = asfarray(inputs[0])
-        imu = array([inputs[1]])
-        if self.scaler:
-            imu_in = self.scaler.transform(imu)
-        else:
-            imu_in = imu
-        img_in = img.reshape((1,)+img.shape)
+        img_in, imu_in = self.preprocess(inputs[0], inputs[1])
 
         # grab inference
-        pred = self.model([img_in, imu_in], training=False)
-        
-        if len(pred) == 1:
-            st_pred = pred.numpy()[0][0]
-            th_pred = 1.0
-            br_pred = 0.0
-#        checks if single or dual ouput based on return type
-        elif isinstance(pred, list): # double output
-            st_pred = pred[0].numpy()[0][0]
-            th_pred = pred[1].numpy()[0][0]
+        pred = self.backend.predict(img_in, imu_in)
+
+        if self.outputs == 'controls':
+            # one output per head (steering, throttle[, brake]), or a
+            # single output holding steering[, throttle[, brake]]
+            if len(pred) > 1:
+                st_pred = pred[0][0][0]
+                th_pred = pred[1][0][0]
+                br_pred = pred[2][0][0] if len(pred) > 2 else 0.0
+            else:
+                values = pred[0][0]
+                st_pred = values[0]
+                th_pred = values[1] if values.shape[-1] > 1 else 1.0
+                br_pred = values[2] if values.shape[-1] > 2 else 0.0
+        elif len(pred) > 1:
+            st_pred = pred[0][0][0]
+            th_pred = pred[1][0][0]
             br_pred = 0.0
         else:
-            st_pred = pred.numpy()[0][0]
-            th_pred = pred.numpy()[0][1]
-            if pred.shape[-1] == 3:
-                br_pred = pred.numpy()[0][2]
-            else:
-                br_pred = 0.0
+            st_pred = pred[0][0][0]
+            th_pred = 1.0
+            br_pred = 0.0
         return st_pred, th_pred, br_pred
 
 
+class Preprocessor:
+
+    # Turns a frame and a telemetry list into the model's batch-of-one
+    # inputs. A StandardScaler or MinMaxScaler becomes x * scale + offset
+    # in float32; any other scaler falls back to its transform(). Both
+    # inputs are written into buffers reused every call, so their contents
+    # only hold until the next one.
+
+    def __init__(self, backend, scaler, n_columns):
+        self.image_dtype = np.dtype(backend.image_dtype)
+        self.image_buffer = None
+        imu_dtype = np.dtype(backend.imu_dtype)
+        self.imu_buffer = np.zeros((1, n_columns),
+                                   dtype=imu_dtype if imu_dtype.kind == 'f' else np.float32)
+        self.scaler = scaler
+        self.scale, self.offset = scaler_affine(scaler, self.imu_buffer.dtype)
+
+    def __call__(self, image, telem):
+        image = asarray(image)
+        if image.dtype == self.image_dtype:
+            # frames from the FrameRing are already in the model's dtype
+            img_in = image[None]
+        else:
+            if self.image_buffer is None or self.image_buffer.shape[1:] != image.shape:
+                self.image_buffer = np.empty((1,) + image.shape, dtype=self.image_dtype)
+            np.copyto(self.image_buffer[0], image, casting='unsafe')
+            img_in = self.image_buffer
+        imu_in = self.imu_buffer
+        imu_in[0] = telem
+        if self.scale is not None:
+            np.multiply(imu_in, self.scale, out=imu_in)
+            np.add(imu_in, self.offset, out=imu_in)
+        elif self.scaler is not None:
+            imu_in = self.scaler.transform(imu_in)
+        return img_in, imu_in
+
+
+def scaler_affine(scaler, dtype):
+    # (scale, offset) with scaler.transform(x) == x * scale + offset, or
+    # (None, None) when the scaler isn't one we can reduce
+    name = type(scaler).__name__
+    if name == 'StandardScaler':
+        # mean_ is filled in even with with_mean off, so go by the flags
+        scale = 1.0 / scaler.scale_ if scaler.with_std else 1.0
+        offset = -scaler.mean_ * scale if scaler.with_mean else 0.0
+    elif name == 'MinMaxScaler' and not getattr(scaler, 'clip', False):
+        scale, offset = scaler.scale_, scaler.min_
+    else:
+        return None, None
+    return asarray(scale, dtype=dtype), asarray(offset, dtype=dtype)
+
+
+class InferenceWorker:
+
+    # Runs the pilot on a thread of its own. submit() hands over the newest
+    # frame and telemetry without waiting; a frame the worker hasn't
+    # started on yet is replaced (and counted as skipped), so it always
+    # works on the latest one. wait() returns the newest prediction not
+    # yet taken as (steering, throttle, brake, frame_time), frame_time
+    # being the sim time of the frame it came from. Frames are FrameRing
+    # views, so the ring must outlast one inference.
+
+    def __init__(self, pilot, latency=None):
+        self.pilot = pilot
+        self.latency = latency
+        self.pending = None
+        self.result = None
+        self.result_count = 0
+        self.taken_count = 0
+        self.submitted = 0
+        self.skipped = 0
+        self.running = True
+        self.cond = threading.Condition()
+        self.result_cond = threading.Condition()
+        self.th = threading.Thread(target=self.run, daemon=True)
+        self.th.start()
+
+    def submit(self, image, telem, frame_time):
+        with self.cond:
+            if self.pending is not None:
+                self.skipped += 1
+            self.pending = (image, telem, frame_time)
+            self.submitted += 1
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.pending is None and self.running:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                image, telem, frame_time = self.pending
+                self.pending = None
+            start = time.perf_counter()
+            try:
+                steering, throttle, brake = self.pilot.infer((image, telem))
+            except Exception as e:
+                print(f"inference failed: {e}")
+                continue
+            if self.latency is not None:
+                self.latency.add('infer', time.perf_counter() - start)
+            with self.result_cond:
+                self.result = (steering, throttle, brake, frame_time)
+                self.result_count += 1
+                self.result_cond.notify_all()
+
+    def wait(self, timeout):
+        # None if nothing new arrives within timeout
+        with self.result_cond:
+            if self.result_count == self.taken_count:
+                self.result_cond.wait(timeout)
+            if self.result_count == self.taken_count:
+                return None
+            self.taken_count = self.result_count
+            return self.result
+
+    def stop(self):
+        with self.cond:
+            if not self.running:
+                return
+            self.running = False
+            self.cond.notify()
+        self.th.join()
+        print(f"inference: {self.submitted} frames submitted, {self.result_count} inferred, "
+              f"{self.skipped} skipped for newer ones")
+
+
+class Backend:
+
+    # subclasses set image_shape and imu_shape (batch of one, None where
+    # the model doesn't fix a size), image_dtype and imu_dtype
+
+    def warm_up(self, runs):
+        # the first few calls are much slower (allocation, graph tracing)
+        if None in self.image_shape or None in self.imu_shape:
+            print(f"input shapes {self.image_shape} {self.imu_shape} not fixed, no warm-up")
+            return
+        img = np.zeros(self.image_shape, dtype=self.image_dtype)
+        imu = np.zeros(self.imu_shape, dtype=self.imu_dtype)
+        for _ in range(runs):
+            self.predict(img, imu)
+
+
+class KerasBackend(Backend):
+
+    def __init__(self, model_path):
+        from tensorflow.keras.models import load_model
+        self.model = load_model(model_path, compile=False)
+        image_input, imu_input = self.model.inputs[:2]
+        dtype = image_input.dtype
+        self.image_dtype = getattr(dtype, 'name', dtype)
+        dtype = imu_input.dtype
+        self.imu_dtype = getattr(dtype, 'name', dtype)
+        self.image_shape = (1,) + tuple(image_input.shape[1:])
+        self.imu_shape = (1,) + tuple(imu_input.shape[1:])
+
+    def predict(self, img_in, imu_in):
+        pred = self.model([img_in, imu_in], training=False)
+        if not isinstance(pred, (list, tuple)):
+            pred = [pred]
+        return [output.numpy() for output in pred]
+
+
+class TFLiteBackend(Backend):
+
+    def __init__(self, model_path):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            from tensorflow.lite import Interpreter
+        self.interpreter = Interpreter(model_path=model_path,
+                                       num_threads=inference_threads or None)
+        self.interpreter.allocate_tensors()
+        inputs = self.interpreter.get_input_details()
+        # converters don't keep the input order; the telemetry input is 2D
+        image_input = next(detail for detail in inputs if len(detail['shape']) > 2)
+        imu_input = next(detail for detail in inputs if detail is not image_input)
+        self.image_index = image_input['index']
+        self.imu_index = imu_input['index']
+        self.image_dtype = np.dtype(image_input['dtype']).name
+        self.imu_dtype = np.dtype(imu_input['dtype']).name
+        self.image_shape = tuple(image_input['shape'])
+        self.imu_shape = tuple(imu_input['shape'])
+        self.output_indexes = [detail['index'] for detail in self.interpreter.get_output_details()]
+
+    def predict(self, img_in, imu_in):
+        if img_in.ndim < len(self.image_shape):
+            # grayscale frames come without the channel axis
+            img_in = img_in[..., None]
+        self.interpreter.set_tensor(self.image_index, img_in)
+        self.interpreter.set_tensor(self.imu_index, asarray(imu_in, dtype=self.imu_dtype))
+        self.interpreter.invoke()
+        return [self.interpreter.get_tensor(index) for index in self.output_indexes]
+
+
+class OnnxBackend(Backend):
+
+    def __init__(self, model_path):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        if inference_threads:
+            options.intra_op_num_threads = inference_threads
+        self.session = onnxruntime.InferenceSession(model_path, options,
+                                                    providers=['CPUExecutionProvider'])
+        inputs = self.session.get_inputs()
+        image_input = next(node for node in inputs if len(node.shape) > 2)
+        imu_input = next(node for node in inputs if node is not image_input)
+        self.image_name = image_input.name
+        self.imu_name = imu_input.name
+        self.image_dtype = ONNX_DTYPES.get(image_input.type, 'float32')
+        self.imu_dtype = ONNX_DTYPES.get(imu_input.type, 'float32')
+        # symbolic dims (batch, or sizes left open) come back as strings
+        self.image_shape = (1,) + tuple(dim if isinstance(dim, int) else None
+                                        for dim in image_input.shape[1:])
+        self.imu_shape = (1,) + tuple(dim if isinstance(dim, int) else None
+                                      for dim in imu_input.shape[1:])
+
+    def predict(self, img_in, imu_in):
+        if img_in.ndim < len(self.image_shape):
+            img_in = img_in[..., None]
+        return self.session.run(None, {self.image_name: img_in,
+                                       self.imu_name: asarray(imu_in, dtype=self.imu_dtype)})
+
+
+BACKEND_CLASSES = {'keras': KerasBackend, 'tflite': TFLiteBackend, 'onnx': OnnxBackend}
+
+
+class ModelRegistry:
+
+    # The model history indexed by model_index. The file is only re-read
+    # when its mtime changes, and telemetry_columns is parsed with
+    # ast.literal_eval instead of eval. Backends (warmed up) and scalers
+    # are cached by file and mtime, so a client rebuilt after a reset gets
+    # the already-loaded ones.
+
+    def __init__(self, history_file):
+        self.history_file = history_file
+        self.mtime = None
+        self.rows = {}
+        self.backends = {}
+        self.scalers = {}
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        mtime = os.path.getmtime(self.history_file)
+        if mtime == self.mtime:
+            return
+        with open(self.history_file) as csv_file:
+            self.rows = {int(row['model_index']): row for row in csv.DictReader(csv_file)}
+        self.mtime = mtime
+
+    def entry(self, model_number):
+        with self.lock:
+            self.refresh()
+            row = self.rows.get(model_number)
+        if row is None:
+            raise KeyError(f"model {model_number} is not in {self.history_file}")
+        try:
+            telemetry_columns = ast.literal_eval(row['telemetry_columns'])
+        except (ValueError, SyntaxError):
+            raise ValueError(f"model {model_number}: bad telemetry_columns "
+                             f"{row['telemetry_columns']!r}")
+        return {
+            'model_file': row['model_file'],
+            'scaler_file': row['scaler_file'],
+            'telemetry_columns': list(telemetry_columns),
+            'backend': model_backend(row),
+            'outputs': model_outputs(row),
+        }
+
+    def backend(self, entry):
+        path = f"{model_directory}/{entry['model_file']}"
+        key = (path, os.path.getmtime(path), entry['backend'])
+        with self.lock:
+            backend = self.backends.get(key)
+            if backend is None:
+                start = time.perf_counter()
+                backend = BACKEND_CLASSES[entry['backend']](path)
+                backend.warm_up(inference_warmup)
+                self.backends[key] = backend
+                print(f"{entry['model_file']} on {entry['backend']} loaded in "
+                      f"{time.perf_counter() - start:.1f}s")
+        return backend
+
+    def scaler(self, scaler_file):
+        path = f"{scaler_directory}/{scaler_file}"
+        key = (path, os.path.getmtime(path))
+        with self.lock:
+            scaler = self.scalers.get(key)
+            if scaler is None:
+                with open(path, 'rb') as pickle_file:
+                    scaler = self.scalers[key] = load(pickle_file)
+                print(f"{scaler_file = }")
+        return scaler
+
+
+REGISTRIES = {}
+
+
+def registry(history_file=model_history):
+    # one registry per history file, shared by every client in the process
+    if history_file not in REGISTRIES:
+        REGISTRIES[history_file] = ModelRegistry(history_file)
+    return REGISTRIES[history_file]
+
+
+def model_backend(row):
+    backend = (row.get('backend') or '').strip().lower()
+    if backend:
+        if backend not in BACKENDS:
+            raise ValueError(f"model {row['model_index']}: unknown backend {backend!r}")
+        return backend
+    ext = os.path.splitext(row['model_file'])[1].lower()
+    return {'.tflite': 'tflite', '.onnx': 'onnx'}.get(ext, 'keras')
+
+
+def model_outputs(row):
+    outputs = (row.get('outputs') or '').strip().lower() or 'steering'
+    if outputs not in OUTPUTS:
+        raise ValueError(f"model {row['model_index']}: unknown outputs {outputs!r}")
+    return outputs
+
+
 def model_paths(model_history_file, model_number):
-    with open(model_history_file) as csv_file:
-        csv_reader = csv.DictReader(csv_file)
-        for row in csv_reader:
-            if int(row['model_index']) == model_number:
-                return {
-                    'model_file': row['model_file'], 
-                    'scaler_file': row['scaler_file'], 
-                    'telemetry_columns': eval(row['telemetry_columns'])  
-                    }
+    return registry(model_history_file).entry(model_number)
@@ -0,0 +1,440 @@
+# Local stand-in for the donkey sim. Replays sessions recorded by CSVRecorder
+# (data.csv + images/) over the sim's TCP protocol (see donkey_sim_api.md) so
+# the clients can be benchmarked without Unity or a remote server.
+#
+#   python replay_server.py ../data/06_01_2022/12_00_00 --rate 0 --loop
+#   python auto_drive.py --host 127.0.0.1 --mode race --model_number 42
+#
+# Frames go out at --rate Hz (0 = as fast as the client reads them). For each
+# connection the server counts frames consumed (written to the client),
+# dropped (skipped because the client had fallen behind) and answered (a
+# control arrived before the next frame), with timing percentiles. At
+# --rate 0 a frame counts as consumed once the socket has taken all of it,
+# i.e. the kernel's buffer, not necessarily the client, has it.
+#
+# Each frame is sent with its recorded sim 'time', shifted so it keeps
+# increasing when the replay loops, the car is reset or the next session
+# starts, so clients can key files and latencies on it.
+
+import argparse
+import asyncio
+import base64
+import csv
+import json
+import os
+import re
+import time
+
+# added to the telemetry by the clients rather than sent by the sim
+CLIENT_COLUMNS = ['lap', 'brake', 'first_lap']
+
+PROTOCOL_VERSION = '2'
+
+# seconds between frames when the recording doesn't say
+DEFAULT_STEP = 0.05
+
+TRAILING_COMMA = re.compile(r',\s*}')
+MSG_TYPE = re.compile(r'"msg_type"\s*:\s*"(\w+)"')
+
+
+class ReplaySession:
+
+    def __init__(self, session_dirs, max_frames=None):
+        self.frames = []
+        self.times = []
+        self.track = None
+        self.img_w = None
+        self.img_h = None
+        for session_dir in session_dirs:
+            self.load(session_dir, max_frames)
+        if not self.frames:
+            raise ValueError('no frames found in ' + ', '.join(session_dirs))
+        # the usual gap between recorded frames, put between two frames
+        # whose recorded times don't increase
+        steps = sorted(b - a for a, b in zip(self.times, self.times[1:]) if b > a)
+        self.step = steps[len(steps) // 2] if steps else DEFAULT_STEP
+        print(f"loaded {len(self.frames)} frames from {len(session_dirs)} session(s)")
+
+    def load(self, session_dir, max_frames):
+        conf_path = f'{session_dir}/conf'
+        if os.path.isfile(conf_path) and self.track is None:
+            with open(conf_path) as conf_file:
+                self.track = json.load(conf_file).get('track')
+        with open(f'{session_dir}/data.csv', newline='') as csv_file:
+            for row in csv.DictReader(csv_file):
+                if max_frames and len(self.frames) >= max_frames:
+                    break
+                self.frames.append(self.build_frame(session_dir, row))
+                try:
+                    self.times.append(float(row['time']))
+                except (KeyError, TypeError, ValueError):
+                    self.times.append(self.times[-1] + DEFAULT_STEP if self.times else 0.0)
+
+    def build_frame(self, session_dir, row):
+        packet = {'msg_type': 'telemetry'}
+        for key, value in row.items():
+            if key in CLIENT_COLUMNS or key == 'time':
+                continue
+            if key == 'image':
+                value = self.load_image(f'{session_dir}/images/{value}')
+            else:
+                value = parse_value(value)
+            packet[key] = value
+        # everything but the closing brace; 'time' is appended per send so
+        # looped replays keep a monotonic sim clock (see sim_time)
+        return (json.dumps(packet)[:-1] + ', "time": ').encode('utf-8')
+
+    def load_image(self, image_path):
+        with open(image_path, 'rb') as image_file:
+            encoded = image_file.read()
+        if self.img_w is None:
+            # PNG keeps width/height in the IHDR chunk
+            if encoded[:8] == b'\x89PNG\r\n\x1a\n':
+                self.img_w = int.from_bytes(encoded[16:20], 'big')
+                self.img_h = int.from_bytes(encoded[20:24], 'big')
+        return base64.b64encode(encoded).decode('ascii')
+
+
+class ConnectionStats:
+
+    def __init__(self, peer):
+        self.peer = peer
+        self.start = time.perf_counter()
+        self.end = None
+        self.consumed = 0
+        self.dropped = 0
+        self.answered = 0
+        self.controls = 0
+        self.unparsed = 0
+        self.control_latency = [] # frame written -> first control after it
+        self.frame_interval = [] # between consecutive frames written
+        self.last_frame = None
+        self.pending_frame = None
+
+    def frame_sent(self, now):
+        if self.last_frame is not None:
+            self.frame_interval.append(now - self.last_frame)
+        self.last_frame = now
+        self.pending_frame = now
+        self.consumed += 1
+
+    def control_received(self, now):
+        self.controls += 1
+        if self.pending_frame is not None:
+            self.answered += 1
+            self.control_latency.append(now - self.pending_frame)
+            self.pending_frame = None
+
+    def summary(self):
+        elapsed = (self.end or time.perf_counter()) - self.start
+        return {
+            'peer': self.peer,
+            'seconds': round(elapsed, 3),
+            'consumed': self.consumed,
+            'dropped': self.dropped,
+            'answered': self.answered,
+            'controls': self.controls,
+            'unparsed': self.unparsed,
+            'fps': round(self.consumed / elapsed, 2) if elapsed else 0.0,
+            'control_latency_ms': percentiles(self.control_latency),
+            'frame_interval_ms': percentiles(self.frame_interval),
+        }
+
+    def print_summary(self):
+        s = self.summary()
+        print(f"{s['peer']}: {s['consumed']} consumed, {s['dropped']} dropped, "
+              f"{s['answered']} answered ({s['controls']} controls) "
+              f"in {s['seconds']:.1f}s, {s['fps']:.1f} fps")
+        for name in ['control_latency_ms', 'frame_interval_ms']:
+            p = s[name]
+            if p:
+                print(f"  {name}: p50 {p['p50']:.2f}  p95 {p['p95']:.2f}  "
+                      f"p99 {p['p99']:.2f}  max {p['max']:.2f}")
+
+
+class ReplayConnection:
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.session = server.session
+        self.reader = reader
+        self.writer = writer
+        self.stats = ConnectionStats(str(writer.get_extra_info('peername')))
+        self.index = 0
+        self.time_offset = 0.0
+        self.last_time = None
+        self.streamer = None
+        self.answered = asyncio.Event()
+
+    async def run(self):
+        print(f"client connected: {self.stats.peer}")
+        buffer = b''
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    break
+                buffer += data
+                msgs, buffer = split_messages(buffer)
+                for msg in msgs:
+                    if self.on_msg(msg) is False:
+                        return
+        except ConnectionError:
+            pass
+        finally:
+            self.stop_streaming()
+            self.writer.close()
+            self.stats.end = time.perf_counter()
+            self.stats.print_summary()
+            self.server.finished(self.stats)
+
+    def on_msg(self, msg):
+        now = time.perf_counter()
+        json_packet = parse_message(msg)
+        if json_packet is None:
+            self.stats.unparsed += 1
+            return
+        msg_type = json_packet['msg_type']
+        if msg_type == 'control':
+            self.stats.control_received(now)
+            self.answered.set()
+        elif msg_type == 'load_scene':
+            self.send({'msg_type': 'scene_loaded'})
+            self.send({'msg_type': 'car_loaded'})
+            self.start_streaming()
+        elif msg_type == 'reset_car':
+            self.index = 0
+        elif msg_type == 'exit_scene':
+            self.stop_streaming()
+            self.send({'msg_type': 'scene_selection_ready'})
+        elif msg_type == 'get_protocol_version':
+            self.send({'msg_type': 'protocol_version', 'version': PROTOCOL_VERSION})
+        elif msg_type == 'get_scene_names':
+            self.send({'msg_type': 'scene_names', 'scene_names': [self.session.track]})
+        elif msg_type == 'cam_config':
+            self.check_cam_config(json_packet)
+        elif msg_type == 'quit_app':
+            return False
+
+    def check_cam_config(self, cam_config):
+        if self.session.img_w is None:
+            return
+        try:
+            size = int(cam_config.get('img_w', 0)), int(cam_config.get('img_h', 0))
+        except ValueError:
+            return
+        if size != (self.session.img_w, self.session.img_h) and size != (0, 0):
+            print(f"warning: client asked for {size[0]}x{size[1]}, replaying "
+                  f"{self.session.img_w}x{self.session.img_h}")
+
+    def send(self, json_packet):
+        self.writer.write((json.dumps(json_packet) + '\n').encode('utf-8'))
+
+    def sim_time(self, index):
+        # the recorded time, moved on by however much keeps it increasing
+        sim_time = self.session.times[index] + self.time_offset
+        if self.last_time is not None and sim_time <= self.last_time:
+            sim_time = self.last_time + self.session.step
+            self.time_offset = sim_time - self.session.times[index]
+        self.last_time = sim_time
+        return sim_time
+
+    def start_streaming(self):
+        if self.streamer is None:
+            self.streamer = asyncio.create_task(self.stream())
+
+    def stop_streaming(self):
+        if self.streamer is not None:
+            self.streamer.cancel()
+            self.streamer = None
+
+    async def stream(self):
+        frames = self.session.frames
+        rate = self.server.rate
+        period = 1.0 / rate if rate else 0.0
+        transport = self.writer.transport
+        if not period:
+            # drain() then waits for the socket to take the whole frame
+            transport.set_write_buffer_limits(high=0)
+        next_send = time.perf_counter()
+        while True:
+            if self.index >= len(frames):
+                if not self.server.loop:
+                    print(f"{self.stats.peer}: end of replay")
+                    return
+                self.index = 0
+            if period:
+                next_send += period
+                delay = next_send - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                else:
+                    # running late: don't try to catch up with a burst
+                    next_send = time.perf_counter()
+            if self.server.lockstep and self.stats.consumed:
+                try:
+                    await asyncio.wait_for(self.answered.wait(), self.server.lockstep_timeout)
+                except asyncio.TimeoutError:
+                    pass
+            index = self.index
+            frame = frames[index]
+            self.index += 1
+            # the real sim doesn't wait for slow clients either
+            if period and transport.get_write_buffer_size() > len(frame):
+                self.stats.dropped += 1
+                continue
+            self.answered.clear()
+            self.writer.write(frame + f'{self.sim_time(index)!r}}}\n'.encode('utf-8'))
+            if not period:
+                await self.writer.drain()
+                self.stats.frame_sent(time.perf_counter())
+                continue
+            self.stats.frame_sent(time.perf_counter())
+            if self.stats.consumed % 64 == 0:
+                # let the event loop service the reader even at high rates
+                await asyncio.sleep(0)
+
+
+class ReplayServer:
+
+    def __init__(self, session, rate, loop=False, lockstep=False, report=None):
+        self.session = session
+        self.rate = rate
+        self.loop = loop
+        self.lockstep = lockstep
+        self.lockstep_timeout = 1.0
+        self.report = report
+
+    async def handle(self, reader, writer):
+        await ReplayConnection(self, reader, writer).run()
+
+    def finished(self, stats):
+        if self.report:
+            with open(self.report, 'a') as report_file:
+                report_file.write(json.dumps(stats.summary()) + '\n')
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"replay server listening on {host}:{port} "
+              f"({'max' if not self.rate else self.rate} fps)")
+        async with server:
+            await server.serve_forever()
+
+
+def split_messages(buffer):
+    # clients don't newline-terminate what they send, so split the stream on
+    # balanced braces instead
+    msgs = []
+    depth = 0
+    in_string = False
+    escaped = False
+    start = 0
+    for i, c in enumerate(buffer):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif c == 0x5c: # backslash
+                escaped = True
+            elif c == 0x22: # quote
+                in_string = False
+        elif c == 0x22:
+            in_string = True
+        elif c == 0x7b: # {
+            if depth == 0:
+                start = i
+            depth += 1
+        elif c == 0x7d and depth: # }
+            depth -= 1
+            if depth == 0:
+                msgs.append(buffer[start:i + 1])
+    if depth:
+        return msgs, buffer[start:]
+    return msgs, b''
+
+
+def parse_message(msg):
+    msg = msg.decode('utf-8', errors='replace')
+    try:
+        return json.loads(msg)
+    except ValueError:
+        pass
+    # Client.config_builder leaves a trailing comma, which the sim tolerates
+    try:
+        return json.loads(TRAILING_COMMA.sub('}', msg))
+    except ValueError:
+        pass
+    # still unparseable (e.g. a bad escape in racer_info) but the type is enough
+    match = MSG_TYPE.search(msg)
+    if match:
+        return {'msg_type': match.group(1)}
+    return None
+
+
+def parse_value(value):
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def percentiles(values):
+    if not values:
+        return None
+    ordered = sorted(values)
+    last = len(ordered) - 1
+    def pick(q):
+        return round(ordered[round(q * last)] * 1000, 3)
+    return {
+        'count': len(ordered),
+        'p50': pick(0.50),
+        'p95': pick(0.95),
+        'p99': pick(0.99),
+        'max': round(ordered[-1] * 1000, 3),
+    }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="donkeysim replay server")
+    parser.add_argument("sessions",
+                        nargs='+',
+                        help="CSVRecorder session directories to replay",)
+    parser.add_argument("--host",
+                        type=str,
+                        default="127.0.0.1",
+                        help="host to listen on",)
+    parser.add_argument("--port",
+                        type=int,
+                        default=9091,
+                        help="port to listen on",)
+    parser.add_argument("--rate",
+                        type=float,
+                        default=20.0,
+                        help="telemetry frames per second, 0 for as fast as possible",)
+    parser.add_argument("--loop",
+                        action='store_true',
+                        help="restart the replay when it runs out of frames",)
+    parser.add_argument("--lockstep",
+                        action='store_true',
+                        help="wait for a control before sending the next frame",)
+    parser.add_argument("--max_frames",
+                        type=int,
+                        default=None,
+                        help="only load this many frames",)
+    parser.add_argument("--report",
+                        type=str,
+                        default=None,
+                        help="append per-client stats as JSON lines to this file",)
+
+    args = parser.parse_args()
+    session = ReplaySession(args.sessions, args.max_frames)
+    server = ReplayServer(session, args.rate, loop=args.loop,
+                          lockstep=args.lockstep, report=args.report)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        print("replay server stopped")
@@ -21,7 +21,7 @@ import gym
 import gym_donkeycar
 
 from controller import Controller
-from sim_recorder import GymRecorder, SimRecorder
+from sim_recorder import GymRecorder
 
 
 def test_track(env_name, conf):
@@ -96,6 +96,8 @@ def simulate(env, conf):
             print("done w test.") #, info)
             break
 
+    rec.close()
+
 def exit_scene(env):
     env.viewer.exit_scene()
 
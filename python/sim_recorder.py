@@ -2,30 +2,72 @@ import os
 import time
 import csv
 import json
+import queue
 import shutil
-import base64
+import threading
+import traceback
+import zlib
+
+from collections import deque
+from itertools import count
 
 from io import BytesIO
+
+import numpy as np
 from PIL import Image
 
 # from conf import TELEMETRY_COLUMNS
 import config as config
+from telemetry import TelemetryPacket
+
+# PIL's names for config.image_format
+PIL_FORMATS = {'PNG': 'PNG', 'JPG': 'JPEG', 'JPEG': 'JPEG', 'TGA': 'TGA'}
 
 
 class GymRecorder:
 
+    # The observation and info dict from each step of the gym loop in
+    # robocar_gym.py, stored as columns (see ColumnStore). The numpy
+    # observation goes in as it is and info's vectors (pos, gyro, accel,
+    # vel, car, lidar) become fixed-length float32 columns, so nothing is
+    # encoded or decoded per step. Reads back with load_columnar.
+
     def __init__(self, conf):
-        telem_type = 'gym'
-        image_format = 'png'
-        image_depth = conf['cam_resolution'][2]
-        self.recorder = CSVRecorder(image_format, image_depth, telem_type)
+        time_str = time.strftime("%m_%d_%Y/%H_%M_%S")
+        self.dir = f'{os.getcwd()}/../data/{time_str}'
+        os.makedirs(self.dir, exist_ok=True)
+        with open(f'{self.dir}/conf', 'x') as conf_file:
+            conf_file.write(json.dumps(conf))
+        # created with the first step, once the observation shape is known
+        self.store = None
+        print(f"DATA DIR: {self.dir}")
 
-    def record(self, json_packet):
-        self.recorder.record(json_packet)
+    def record(self, info):
+        if self.store is None:
+            obs = np.asarray(info['image'])
+            columns = [('image', obs.dtype, obs.shape)]
+            columns += column_specs(config.TELEMETRY_COLUMNS['gym'], info)
+            self.store = ColumnStore(self.dir, columns, config.columnar_block_bytes)
+        self.store.append(info)
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+            print(f"{self.store.rows} steps written to {self.dir}")
 
 
 class SimRecorder:
 
+    # With config.record_queue > 0, record() only queues the packet and
+    # config.record_workers threads encode and write it, so a slow disk
+    # doesn't hold up the telemetry thread. When the queue is full,
+    # config.record_full_policy decides: 'block' (the default) waits for room,
+    # 'drop_oldest' discards the oldest queued frame, 'drop_newest' discards
+    # the incoming one. With more than one worker, rows can be written a few
+    # frames out of order (the 'time' column still sorts them).
+    # Every written frame also goes into the session's EventIndex. Frames
+    # the FrameFilter rejects are never queued.
+
     def __init__(self, conf):
         record_format = config.record_format 
         image_format = config.image_format
@@ -34,18 +76,518 @@ class SimRecorder:
         if record_format == 'tub':
             self.recorder = TubRecorder(image_format, image_depth)
         elif record_format == 'CSV':
-            self.recorder = CSVRecorder(conf)
+            # one session across car resets: the next client's recorder
+            # picks up conf['session_dir'] and appends a segment to it
+            self.recorder = CSVRecorder(conf, conf.get('session_dir'))
+            conf['session_dir'] = self.recorder.dir
         elif record_format == 'ASL':
             self.recorder = ASLRecorder(image_format, image_depth)
+        elif record_format == 'columnar':
+            self.recorder = ColumnarRecorder(conf)
         else:
             self.recorder = None
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.index = None
+        if self.recorder is not None:
+            # only CSV sessions are resumed, so only they start past row 0
+            self.index = EventIndex(self.recorder.dir, getattr(self.recorder, 'first_row', 0),
+                                    getattr(self.recorder, 'segment', 0))
+        self.filter = FrameFilter(config.record_dedup, config.record_interval,
+                                  config.record_dedup_tolerance)
+        self.queue = None
+        self.workers = []
+        if config.record_queue and self.recorder is not None:
+            self.queue = queue.Queue(config.record_queue)
+            self.policy = config.record_full_policy
+            # ASL rows must stay in time order
+            workers = 1 if record_format == 'ASL' else config.record_workers
+            for _ in range(workers):
+                worker = threading.Thread(target=self.work, daemon=True)
+                worker.start()
+                self.workers.append(worker)
 
     def record(self, json_packet):
-        self.recorder.record(json_packet)
+        if not self.filter.keep(json_packet):
+            return
+        if self.queue is None:
+            row = self.recorder.record(json_packet)
+            self.written += 1
+            self.index.add(row, json_packet)
+            return
+        if self.policy == 'block':
+            self.queue.put(json_packet)
+        else:
+            try:
+                self.queue.put_nowait(json_packet)
+            except queue.Full:
+                if self.policy == 'drop_newest':
+                    self.dropped += 1
+                    return
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+                # only this thread adds to the queue, so there's room now
+                self.queue.put_nowait(json_packet)
+        self.enqueued += 1
+
+    def work(self):
+        while True:
+            json_packet = self.queue.get()
+            if json_packet is None:
+                return
+            try:
+                row = self.recorder.record(json_packet)
+            except Exception:
+                traceback.print_exc()
+                continue
+            with self.lock:
+                self.written += 1
+            self.index.add(row, json_packet)
+
+    def mark_lap(self, lap, lap_time):
+        # lap time as the client timed it, from on_full_lap
+        if self.index is not None:
+            self.index.mark_lap(lap, lap_time)
+
+    def close(self):
+        if self.recorder is None:
+            return
+        # workers finish everything queued ahead of their stop signal
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.recorder.close()
+        self.recorder = None
+        self.index.close()
+        if self.queue is not None:
+            print(f"recorder: {self.enqueued} enqueued, {self.written} written, "
+                  f"{self.dropped} dropped")
+        self.filter.report()
+
+
+class BlackBoxRecorder:
+
+    # Holds the last config.black_box_seconds of frames in memory, as the
+    # encoded image bytes plus one float64 array of telemetry each, and
+    # only writes them (as a CSV session under ../data/black_box) when a
+    # trigger in config.black_box_triggers fires: the first frame of a hit,
+    # trigger('reset') from the client, or a lap slower than
+    # config.black_box_slow_lap. Frames go once the ring holds more than
+    # config.black_box_max_bytes. Everything is called on the telemetry
+    # thread; dumps are written on a thread of their own.
+
+    # bytes per held frame on top of its image and telemetry
+    FRAME_OVERHEAD = 200
+
+    def __init__(self, conf):
+        self.conf = dict(conf)
+        telem_cols = [col for col in config.TELEMETRY_COLUMNS[conf['telem_type']]
+                      if col != 'image']
+        self.text_cols = [col for col in telem_cols
+                          if np.dtype(config.TELEMETRY_DTYPES.get(col, 'float32')).kind == 'U']
+        self.value_cols = [col for col in telem_cols if col not in self.text_cols]
+        self.int_cols = {col for col in self.value_cols
+                         if np.dtype(config.TELEMETRY_DTYPES.get(col, 'float32')).kind in 'iu'}
+        self.seconds = config.black_box_seconds
+        self.max_bytes = config.black_box_max_bytes
+        self.triggers = config.black_box_triggers
+        self.slow_lap = config.black_box_slow_lap
+        self.ring = deque() # (sim time, image bytes, values, texts, size)
+        self.bytes = 0
+        self.peak_bytes = 0
+        self.peak_frames = 0
+        self.evicted = 0
+        self.last_hit = 'none'
+        self.dumps = []
+        print(f"black box: holding {self.seconds:.0f}s, at most "
+              f"{self.max_bytes / 2**20:.0f} MiB, dumping on {', '.join(self.triggers)}")
+
+    def record(self, json_packet):
+        sim_time = float(json_packet['time'])
+        encoded = json_packet.image_bytes
+        values = np.array([json_packet.get(col, np.nan) for col in self.value_cols],
+                          dtype='float64')
+        texts = tuple(str(json_packet.get(col, '')) for col in self.text_cols)
+        size = len(encoded) + values.nbytes + self.FRAME_OVERHEAD
+        self.ring.append((sim_time, encoded, values, texts, size))
+        self.bytes += size
+        while self.ring and (self.bytes > self.max_bytes
+                             or sim_time - self.ring[0][0] > self.seconds):
+            self.bytes -= self.ring.popleft()[4]
+            self.evicted += 1
+        self.peak_bytes = max(self.peak_bytes, self.bytes)
+        self.peak_frames = max(self.peak_frames, len(self.ring))
+        hit = json_packet.get('hit', 'none')
+        if hit != 'none' and self.last_hit == 'none':
+            self.trigger('hit')
+        self.last_hit = hit
+
+    def mark_lap(self, lap, lap_time):
+        if self.slow_lap and lap_time > self.slow_lap:
+            self.trigger('slow_lap')
+
+    def trigger(self, reason):
+        if reason not in self.triggers or not self.ring:
+            return
+        frames = list(self.ring)
+        held = self.bytes
+        # dumped frames aren't dumped again by the next trigger
+        self.ring.clear()
+        self.bytes = 0
+        time_str = time.strftime("%m_%d_%Y/%H_%M_%S")
+        session_dir = f'{os.getcwd()}/../data/black_box/{time_str}_{reason}_{len(self.dumps)}'
+        print(f"black box: {reason}, writing {len(frames)} frames "
+              f"({held / 2**20:.1f} MiB) to {session_dir}")
+        dump = threading.Thread(target=self.dump, args=(frames, session_dir))
+        dump.start()
+        self.dumps.append(dump)
+
+    def dump(self, frames, session_dir):
+        try:
+            recorder = CSVRecorder(self.conf, session_dir)
+            for _, encoded, values, texts, _ in frames:
+                fields = {col: int(value) if col in self.int_cols else value
+                          for col, value in zip(self.value_cols, values.tolist())}
+                fields.update(zip(self.text_cols, texts))
+                recorder.record(TelemetryPacket.from_encoded(fields, encoded))
+            recorder.close()
+        except Exception:
+            traceback.print_exc()
+
+    def close(self):
+        for dump in self.dumps:
+            dump.join()
+        print(f"black box: {len(self.dumps)} dumps, peak {self.peak_frames} frames "
+              f"in {self.peak_bytes / 2**20:.1f} MiB (cap {self.max_bytes / 2**20:.0f} MiB), "
+              f"{self.evicted} frames aged out")
+
+
+class FrameFilter:
+
+    # Decides on the telemetry thread which frames are worth recording. A
+    # frame is a duplicate of the last kept one when its encoded image has
+    # the same crc32 and no telemetry value apart from time has moved by
+    # more than tolerance, as when the car sits at the line. With interval
+    # set, frames less than that many sim seconds after the last kept one
+    # are skipped too, unless they have a hit or a new lap or activeNode,
+    # so the event index sees the same events.
+
+    IGNORED = ('time', 'image')
+
+    def __init__(self, dedup=True, interval=0.0, tolerance=0.0):
+        self.dedup = dedup
+        self.interval = interval
+        self.tolerance = tolerance
+        self.last_crc = None
+        self.last_fields = None
+        self.last_time = None
+        self.kept = 0
+        self.duplicates = 0
+        self.downsampled = 0
+
+    def keep(self, json_packet):
+        if not self.dedup and not self.interval:
+            self.kept += 1
+            return True
+        sim_time = float(json_packet['time'])
+        fields = {key: value for key, value in json_packet.items() if key not in self.IGNORED}
+        crc = zlib.crc32(json_packet.image_bytes) if self.dedup else None
+        if self.dedup and crc == self.last_crc and self.unchanged(fields):
+            self.duplicates += 1
+            return False
+        if (self.interval and self.last_time is not None
+                and sim_time - self.last_time < self.interval
+                and not self.event(fields)):
+            self.downsampled += 1
+            return False
+        self.last_crc = crc
+        self.last_fields = fields
+        self.last_time = sim_time
+        self.kept += 1
+        return True
+
+    def unchanged(self, fields):
+        last = self.last_fields
+        if last is None or last.keys() != fields.keys():
+            return False
+        for key, value in fields.items():
+            if value == last[key]:
+                continue
+            if (type(value) in (int, float) and type(last[key]) in (int, float)
+                    and abs(value - last[key]) <= self.tolerance):
+                continue
+            return False
+        return True
+
+    def event(self, fields):
+        last = self.last_fields
+        return (fields.get('hit', 'none') != 'none'
+                or fields.get('lap') != last.get('lap')
+                or fields.get('activeNode') != last.get('activeNode'))
+
+    def report(self):
+        if self.duplicates or self.downsampled:
+            print(f"frames: {self.kept} kept, {self.duplicates} duplicates and "
+                  f"{self.downsampled} downsampled skipped")
+
+
+class EventIndex:
+
+    # The index.json sidecar of a recording: where each lap starts and
+    # stops, runs of frames with a hit, activeNode changes and the client's
+    # lap times, so a reader can seek straight to those rows instead of
+    # scanning the session. Rows are positions in the recording (data.csv
+    # row, tub record, columnar row). Workers can finish frames out of
+    # order, so a row is held back until every earlier one has arrived.
+    # The file is rewritten when a lap starts or is timed, and at close.
+    # Lap numbers restart with each client, so laps are kept per segment
+    # (one per client in a resumed session); a later segment starts at
+    # first_row and keeps what the earlier ones indexed before that row.
+
+    def __init__(self, path, first_row=0, segment=0):
+        self.path = f'{path}/index.json'
+        self.segment = segment
+        self.rows = first_row
+        self.pending = {}
+        # (segment, lap) -> {'segment', 'lap', 'start', 'stop', 'start_time', 'stop_time', 'hits'}
+        self.laps = {}
+        self.lap_times = {}
+        self.hits = [] # {'start', 'stop', 'hit'} per run of frames with the same hit
+        self.nodes = [] # [row, activeNode] at each change
+        self.lock = threading.RLock()
+        if first_row:
+            self.load(first_row)
+
+    def load(self, first_row):
+        try:
+            with open(self.path) as index_file:
+                index = json.load(index_file)
+        except (OSError, ValueError):
+            return
+        for entry in index['laps']:
+            if entry['start'] >= first_row:
+                continue
+            key = (entry.get('segment', 0), entry['lap'])
+            lap_time = entry.pop('time')
+            if entry['stop'] > first_row:
+                # cut short by the rows that were never committed
+                entry['stop'] = first_row
+            elif lap_time is not None:
+                self.lap_times[key] = lap_time
+            self.laps[key] = entry
+        self.hits = [dict(hit, stop=min(hit['stop'], first_row))
+                     for hit in index['hits'] if hit['start'] < first_row]
+        self.nodes = [node for node in index['nodes'] if node[0] < first_row]
+
+    def add(self, row, json_packet):
+        event = (json_packet.get('lap'), json_packet.get('hit', 'none'),
+                 json_packet.get('activeNode'), json_packet.get('time'))
+        with self.lock:
+            self.pending[row] = event
+            while self.rows in self.pending:
+                self.index_row(self.rows, *self.pending.pop(self.rows))
+                self.rows += 1
+
+    def index_row(self, row, lap, hit, node, sim_time):
+        lap_entry = self.laps.get((self.segment, lap))
+        if lap is not None and lap_entry is None:
+            # the previous lap is finished; save it before starting this one
+            self.save()
+            lap_entry = self.laps[(self.segment, lap)] = {
+                'segment': self.segment, 'lap': lap, 'start': row, 'start_time': sim_time,
+                'hits': 0}
+        if lap_entry is not None:
+            lap_entry['stop'] = row + 1
+            lap_entry['stop_time'] = sim_time
+        if hit != 'none':
+            last = self.hits[-1] if self.hits else None
+            if last is not None and last['stop'] == row and last['hit'] == hit:
+                last['stop'] = row + 1
+            else:
+                self.hits.append({'start': row, 'stop': row + 1, 'hit': hit})
+                if lap_entry is not None:
+                    lap_entry['hits'] += 1
+        if node is not None and (not self.nodes or self.nodes[-1][1] != node):
+            self.nodes.append([row, node])
+
+    def mark_lap(self, lap, lap_time):
+        with self.lock:
+            self.lap_times[(self.segment, lap)] = lap_time
+            self.save()
+
+    def save(self):
+        with self.lock:
+            index = {
+                'rows': self.rows,
+                'laps': [dict(entry, time=self.lap_times.get(key))
+                         for key, entry in sorted(self.laps.items())],
+                'hits': self.hits,
+                'nodes': self.nodes,
+            }
+            with open(self.path + '.tmp', 'w') as index_file:
+                json.dump(index, index_file)
+            os.replace(self.path + '.tmp', self.path)
+
+    def close(self):
+        with self.lock:
+            # a frame that failed after taking its row leaves a gap; skip it
+            for row in sorted(self.pending):
+                self.rows = row
+                self.index_row(row, *self.pending.pop(row))
+                self.rows += 1
+            self.save()
+
+
+class ImageWriter:
+
+    # Writes the sim's encoded image straight to disk when it is already in
+    # the requested format and depth, and only decodes and re-encodes when a
+    # conversion is needed. The check reads the image header, not the pixels.
+
+    def __init__(self, image_format, image_depth):
+        self.image_format = PIL_FORMATS[image_format.upper()]
+        self.image_depth = image_depth
+        self.fast_path = 0
+        self.converted = 0
+        self.lock = threading.Lock()
+
+    def matches(self, encoded):
+        header = Image.open(BytesIO(encoded))
+        return (header.format == self.image_format
+                and len(header.getbands()) == self.image_depth)
+
+    def write(self, frame, path):
+        if self.matches(frame.encoded):
+            with open(path, 'wb') as image_file:
+                image_file.write(frame.encoded)
+            with self.lock:
+                self.fast_path += 1
+        else:
+            frame.image(self.image_depth).save(path, format=self.image_format)
+            with self.lock:
+                self.converted += 1
+
+    def report(self):
+        print(f"images: {self.fast_path} written as sent, {self.converted} re-encoded")
+
+
+class RowWriter:
+
+    # CSV rows go through a bounded queue to a thread that keeps the file
+    # open, writes whatever has queued up in one batch and flushes every
+    # flush_interval seconds, so record() never waits on the disk.
+    # fsync: 'never', 'flush' (on every flush) or 'close'. sync() waits for
+    # the rows queued so far to reach the file and returns its length.
+    # on_flush(rows, length) is called from the writer thread after each
+    # flush with the rows written so far (not counting the header).
+    # A failed batch is reported and the thread carries on, so writerow()
+    # never blocks on a dead writer; sync() raises once a write has failed.
+
+    def __init__(self, path, header=None, mode='w', flush_interval=1.0,
+                 fsync='close', max_pending=10000, lineterminator='\r\n', on_flush=None):
+        self.path = path
+        self.on_flush = on_flush
+        self.written_rows = 0
+        self.file = open(path, mode, newline='')
+        self.writer = csv.writer(self.file, lineterminator=lineterminator)
+        if header is not None:
+            self.writer.writerow(header)
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.synced_bytes = 0
+        self.error = None
+        self.queue = queue.Queue(max_pending)
+        self.th = threading.Thread(target=self.run, daemon=True)
+        self.th.start()
+
+    def writerow(self, row):
+        # row must be a list or tuple, not a generator
+        self.queue.put(row)
+
+    def run(self):
+        next_flush = time.monotonic() + self.flush_interval
+        running = True
+        while running:
+            try:
+                rows = [self.queue.get(timeout=max(0.0, next_flush - time.monotonic()))]
+            except queue.Empty:
+                rows = []
+            while True:
+                try:
+                    rows.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if rows and rows[-1] is None:
+                rows.pop()
+                running = False
+            try:
+                batch = []
+                for row in rows:
+                    if isinstance(row, threading.Event):
+                        self.writer.writerows(batch)
+                        self.written_rows += len(batch)
+                        batch = []
+                        self.flush(self.fsync == 'flush')
+                        self.synced_bytes = self.file.tell()
+                        row.set()
+                    else:
+                        batch.append(row)
+                self.writer.writerows(batch)
+                self.written_rows += len(batch)
+                if running and time.monotonic() >= next_flush:
+                    self.flush(self.fsync == 'flush')
+                    next_flush = time.monotonic() + self.flush_interval
+            except Exception as e:
+                print(f"error writing {self.path}: {e!r}")
+                self.error = e
+                # don't leave a sync() caller waiting
+                for row in rows:
+                    if isinstance(row, threading.Event):
+                        row.set()
+        try:
+            self.flush(self.fsync != 'never')
+        except Exception as e:
+            print(f"error writing {self.path}: {e!r}")
+            self.error = e
+        finally:
+            self.file.close()
+
+    def flush(self, sync):
+        self.file.flush()
+        if sync:
+            os.fsync(self.file.fileno())
+        if self.on_flush is not None:
+            self.on_flush(self.written_rows, self.file.tell())
+
+    def sync(self):
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait()
+        if self.error is not None:
+            raise OSError(f"writing {self.path} failed: {self.error!r}")
+        return self.synced_bytes
+
+    def close(self):
+        self.queue.put(None)
+        self.th.join()
+
 
 class ASLRecorder:
 
-    def __init__(self):
+    # EuRoC/ASL dataset (mav0/cam0, mav0/imu0) plus the ORB-SLAM3 timestamp
+    # and IMU files. All four text sinks stay open behind RowWriters, frames
+    # are stamped from the sim's 'time' field rather than the wall clock.
+    # Each image is written before its rows, on the calling thread, so a
+    # slow disk backs up SimRecorder's bounded queue (and its
+    # record_full_policy) and a failed image write leaves no rows behind.
+
+    def __init__(self, image_format, image_depth):
         asl_dir = f'{os.getcwd()}/../data/asl'
         dir_num = 1
         dir_str = f'DS{dir_num:02}'
@@ -80,58 +622,32 @@ class ASLRecorder:
         shutil.copy(f'{asl_dir}/body.yaml', self.mav_dir)
         shutil.copy(f'{asl_dir}/cam_sensor.yaml', f'{self.cam_dir}/sensor.yaml')
         shutil.copy(f'{asl_dir}/imu_sensor.yaml', f'{self.imu_dir}/sensor.yaml')
-        # create cam and imu data.csv files
-        self.cam_csv = f'{self.cam_dir}/data.csv'
-        self.imu_csv = f'{self.imu_dir}/data.csv'
-        with open(self.cam_csv, 'w', newline='') as csvfile:
-            row_writer = csv.writer(csvfile)
-            row_writer.writerow(['#timestamp [ns]', 'filename'])
-        with open(self.imu_csv, 'w', newline='') as csvfile:
-            row_writer = csv.writer(csvfile)
-            row_writer.writerow(['#timestamp [ns]', 
-                                'w_RS_S_x [rad s^-1]', 
-                                'w_RS_S_y [rad s^-1]', 
-                                'w_RS_S_z [rad s^-1]', 
-                                'a_RS_S_x [m s^-2]', 
-                                'a_RS_S_y [m s^-2]',
-                                'a_RS_S_z [m s^-2]'
-                                ])
-        # create timestamp files
+        imu_header = ['#timestamp [ns]',
+                      'w_RS_S_x [rad s^-1]',
+                      'w_RS_S_y [rad s^-1]',
+                      'w_RS_S_z [rad s^-1]',
+                      'a_RS_S_x [m s^-2]',
+                      'a_RS_S_y [m s^-2]',
+                      'a_RS_S_z [m s^-2]']
+        sink_args = {'flush_interval': config.flush_interval, 'fsync': config.fsync_policy}
+        # cam and imu data.csv files
+        self.cam_csv = RowWriter(f'{self.cam_dir}/data.csv',
+                                 header=['#timestamp [ns]', 'filename'], **sink_args)
+        self.imu_csv = RowWriter(f'{self.imu_dir}/data.csv', header=imu_header, **sink_args)
+        # timestamp files
         cam_ts_dir = f'{asl_dir}/Monocular-Inertial/DonkeySim_Timestamps'
-        self.cam_ts_file = f'{cam_ts_dir}/{dir_str}.txt'
-        with open(self.cam_ts_file, 'w') as stampfile:
-            pass
+        self.cam_ts = RowWriter(f'{cam_ts_dir}/{dir_str}.txt', lineterminator='\n', **sink_args)
         imu_ts_dir = f'{asl_dir}/Monocular-Inertial/DonkeySim_IMU'
-        self.imu_ts_file = f'{imu_ts_dir}/{dir_str}.txt'
-        with open(self.imu_ts_file, 'w', newline='') as stampfile:
-            stampfile.write('#timestamp [ns],w_RS_S_x [rad s^-1],'
-                            'w_RS_S_y [rad s^-1],w_RS_S_z [rad s^-1],'
-                            'a_RS_S_x [m s^-2],a_RS_S_y [m s^-2],'
-                            'a_RS_S_z [m s^-2]\n')
-
+        self.imu_ts = RowWriter(f'{imu_ts_dir}/{dir_str}.txt', header=imu_header,
+                                lineterminator='\n', **sink_args)
+        self.image_ext = image_format.lower()
+        self.images = ImageWriter(image_format, image_depth)
+        self.row_count = count()
 
     def record(self, json_packet):
-        time_stamp= str(time.time_ns())
-        image = Image.open(
-                    BytesIO(base64.b64decode(json_packet['image']))
-                    ).getchannel(self.image_depth)
-        image.save(f'{self.img_dir}/{time_stamp}.png')
-        with open(self.cam_ts_file, 'a') as stampfile:
-            stampfile.write(time_stamp+'\n')
-        with open(self.cam_csv, 'a', newline='') as csvfile:
-            row_writer = csv.writer(csvfile)
-            row_writer.writerow([time_stamp, time_stamp+'.png'])
-        # imu
-        imu_stamp = (
-            f"{time_stamp},"
-            f"{json_packet['gyro_x']},"
-            f"{json_packet['gyro_y']},"
-            f"{json_packet['accel_x']},"
-            f"{json_packet['accel_y']},"
-            f"{json_packet['accel_z']}\n"
-        )
-        with open(self.imu_ts_file, 'a') as stampfile:
-            stampfile.write(imu_stamp)
+        # sim time is in seconds
+        time_stamp = str(round(float(json_packet['time']) * 1e9))
+        image_file = f'{time_stamp}.{self.image_ext}'
         imu_data = [
             time_stamp,
             float(json_packet['gyro_x']),
@@ -141,9 +657,17 @@ class ASLRecorder:
             float(json_packet['accel_y']),
             float(json_packet['accel_z'])
         ]
-        with open(self.imu_csv, 'a', newline='') as csvfile:
-            row_writer = csv.writer(csvfile)
-            row_writer.writerow(imu_data)
+        self.images.write(json_packet.frame, f'{self.img_dir}/{image_file}')
+        self.cam_ts.writerow([time_stamp])
+        self.cam_csv.writerow([time_stamp, image_file])
+        self.imu_ts.writerow(imu_data)
+        self.imu_csv.writerow(imu_data)
+        return next(self.row_count)
+
+    def close(self):
+        for sink in [self.cam_ts, self.cam_csv, self.imu_ts, self.imu_csv]:
+            sink.close()
+        self.images.report()
 
 class LapRecorder:
 
@@ -165,55 +689,569 @@ class LapRecorder:
 
 class CSVRecorder:
 
-    def __init__(self, conf):
-        time_str = time.strftime("%m_%d_%Y/%H_%M_%S")
-        self.dir = f'{os.getcwd()}/../data/{time_str}'
+    # Given the session_dir of an existing session, appends to its data.csv
+    # as a new segment. Each time the rows are flushed, commits.log gets a
+    # 'segment rows bytes' line; a row is only queued once its image file
+    # is written, so every committed row has its image. Reopening the
+    # session cuts data.csv back to its last commit, dropping whatever a
+    # crashed run had only partly written. Images are named
+    # <segment>_<sim time>.
+
+    def __init__(self, conf, session_dir=None):
+        if session_dir is None:
+            time_str = time.strftime("%m_%d_%Y/%H_%M_%S")
+            session_dir = f'{os.getcwd()}/../data/{time_str}'
+        self.dir = session_dir
         self.img_dir = f'{self.dir}/images'
         os.makedirs(self.dir, exist_ok=True)
         os.makedirs(self.img_dir, exist_ok=True)
         self.csv_file_path = f'{self.dir}/data.csv'
         self.telem_cols = config.TELEMETRY_COLUMNS[conf['telem_type']]
-        with open(f'{self.dir}/conf', 'x') as conf_file:
-            conf_file.write(json.dumps(conf))
-        with open(self.csv_file_path, 'w', newline='') as csv_outfile:
-            row_writer = csv.writer(csv_outfile)
-            row_writer.writerow(self.telem_cols)
+        self.commit_path = f'{self.dir}/commits.log'
+        self.segment = 0
+        existing_rows = 0
+        if os.path.isfile(self.csv_file_path):
+            existing_rows = self.recover()
+        else:
+            with open(f'{self.dir}/conf', 'x') as conf_file:
+                conf_file.write(json.dumps(conf))
+        self.first_row = existing_rows
+        self.commit_file = open(self.commit_path, 'a')
+        self.rows = RowWriter(self.csv_file_path,
+                              header=None if existing_rows else self.telem_cols,
+                              mode='a' if existing_rows else 'w',
+                              flush_interval=config.flush_interval,
+                              fsync=config.fsync_policy,
+                              on_flush=self.commit)
+        if not existing_rows:
+            # commit the header, so a crash before the first flush recovers
+            self.rows.sync()
         self.image_format = conf['image_format'] # 'PNG' # conf.image_format
         self.image_depth = conf['image_depth'] # 1 # conf.image_depth
+        self.images = ImageWriter(self.image_format, self.image_depth)
+        # row numbers must follow the order rows are queued to the writer
+        self.row_count = existing_rows
+        self.lock = threading.Lock()
         print(f"DATA FILE: {self.csv_file_path}")
 
     def record(self, json_packet):
-        image_file = f"{str(json_packet['time']).replace('.','_')}.{self.image_format.lower()}"
-        image = Image.open(BytesIO(base64.b64decode(json_packet['image']))).getchannel(self.image_depth)
-        image.save(f"{self.img_dir}/{image_file}")
+        # sim time restarts with every load_scene, so segments that share
+        # images/ need the segment in the name too
+        image_file = (f"{self.segment}_{str(json_packet['time']).replace('.','_')}"
+                      f".{self.image_format.lower()}")
+        self.images.write(json_packet.frame, f"{self.img_dir}/{image_file}")
         json_packet['image'] = f"{image_file}" 
-        with open(self.csv_file_path, 'a', newline='') as csv_outfile:
-            row_writer = csv.writer(csv_outfile)
-            # row_writer.writerow(value for value in json_packet.values())
-            row_writer.writerow(json_packet[col] for col in self.telem_cols)
+        row = [json_packet[col] for col in self.telem_cols]
+        with self.lock:
+            self.rows.writerow(row)
+            self.row_count += 1
+            return self.row_count - 1
+
+    def recover(self):
+        # rows in data.csv as of its last commit that still fits the file
+        # (convert.py cuts it back to its own checkpoints)
+        size = os.path.getsize(self.csv_file_path)
+        committed = None
+        last_segment = -1
+        if os.path.isfile(self.commit_path):
+            with open(self.commit_path) as commit_file:
+                for line in commit_file:
+                    fields = line.split()
+                    # a line cut off mid-write doesn't count
+                    if not line.endswith('\n') or len(fields) != 3:
+                        continue
+                    segment, rows, length = map(int, fields)
+                    last_segment = max(last_segment, segment)
+                    if length <= size:
+                        committed = rows, length
+        self.segment = last_segment + 1
+        if committed is None:
+            # a session from before commits.log; trust its whole lines
+            lines = length = 0
+            with open(self.csv_file_path, 'rb') as csv_file:
+                for line in csv_file:
+                    if line.endswith(b'\n'):
+                        lines += 1
+                        length += len(line)
+            committed = max(0, lines - 1), length
+        rows, length = committed
+        if length < size:
+            print(f"dropping {size - length} uncommitted bytes from {self.csv_file_path}")
+            with open(self.csv_file_path, 'r+b') as csv_file:
+                csv_file.truncate(length)
+        print(f"resuming {self.dir} at row {rows} (segment {self.segment})")
+        return rows
+
+    def commit(self, rows, length):
+        # from the RowWriter thread, after a flush
+        self.commit_file.write(f'{self.segment} {self.first_row + rows} {length}\n')
+        self.commit_file.flush()
+        if config.fsync_policy == 'flush':
+            os.fsync(self.commit_file.fileno())
+
+    def close(self):
+        self.rows.close()
+        self.commit_file.close()
+        self.images.report()
 
 
 
 
 class TubRecorder:
 
-    def __init__(self, image_format, image_depth):
-        time_str = time.strftime("%m_%d_%Y/%H_%M_%S")
-        self.dir = f'{os.getcwd()}/../data/{time_str}'
-        self.data_dir = f'{self.dir}/tub_data'
-        os.makedirs(self.data_dir, exist_ok=True)
+    # With config.tub_catalog the records go into a TubCatalog (Donkey Car
+    # tub v2 style) instead of one data_NNNN JSON file per frame. Given the
+    # session_dir of an existing tub, carries on numbering after its records.
+    # Catalog images are written under a temporary name and renamed after
+    # their record's index, which is taken under the lock along with the
+    # append, so the two always agree whatever order workers finish in. The
+    # catalog is flushed (and its manifest written) every
+    # config.flush_interval, fsynced as config.fsync_policy says.
+
+    def __init__(self, image_format, image_depth, session_dir=None):
+        if session_dir is None:
+            time_str = time.strftime("%m_%d_%Y/%H_%M_%S")
+            session_dir = f'{os.getcwd()}/../data/{time_str}'
+        self.dir = session_dir
         self.img_dir = f'{self.dir}/images'
         os.makedirs(self.img_dir, exist_ok=True)
         self.image_format = image_format
         self.image_depth = image_depth
-        self.record_count = 0
+        self.images = ImageWriter(image_format, image_depth)
+        if config.tub_catalog:
+            self.catalog = TubCatalog(self.dir, config.tub_catalog_len)
+            self.lock = threading.Lock()
+            self.pending_images = count()
+            self.next_flush = time.monotonic() + config.flush_interval
+        else:
+            self.catalog = None
+            self.data_dir = f'{self.dir}/tub_data'
+            os.makedirs(self.data_dir, exist_ok=True)
+            # next() on a count is atomic, so workers can share it
+            self.record_count = count(len(os.listdir(self.data_dir)))
     
     def record(self, json_packet):
-        image = Image.open(
-            BytesIO(base64.b64decode(json_packet['image']))
-            ).getchannel(self.image_depth)
-        image.save(f'{self.img_dir}/frame_{self.record_count:04d}.png')
+        if self.catalog is not None:
+            ext = self.image_format.lower()
+            pending_path = f'{self.img_dir}/.pending_{next(self.pending_images)}.{ext}'
+            try:
+                self.images.write(json_packet.frame, pending_path)
+            except Exception:
+                if os.path.exists(pending_path):
+                    os.remove(pending_path)
+                raise
+            with self.lock:
+                image_file = f'{self.catalog.current_index}_cam_image_array_.{ext}'
+                os.replace(pending_path, f'{self.img_dir}/{image_file}')
+                json_packet['image'] = image_file
+                index = self.catalog.append(json_packet)
+                now = time.monotonic()
+                if now >= self.next_flush:
+                    self.catalog.flush(config.fsync_policy == 'flush')
+                    self.next_flush = now + config.flush_interval
+            return index
+        record_count = next(self.record_count)
+        self.images.write(json_packet.frame,
+            f'{self.img_dir}/frame_{record_count:04d}.{self.image_format.lower()}')
         del json_packet['image']
-        with open(f'{self.data_dir}/data_{self.record_count:04d}', 'w') as outfile:
+        with open(f'{self.data_dir}/data_{record_count:04d}', 'w') as outfile:
             json.dump(json_packet, outfile)
-        self.record_count += 1 
+        return record_count
+
+    def flush(self):
+        if self.catalog is not None:
+            with self.lock:
+                self.catalog.flush()
+
+    def close(self):
+        if self.catalog is not None:
+            self.catalog.close(config.fsync_policy != 'never')
+        self.images.report()
+
+
+class TubCatalog:
+
+    # Append-only record store laid out like Donkey Car's tub v2: records
+    # are JSON lines in catalog_N.catalog files of max_len records each,
+    # each with a catalog_N.catalog_manifest holding its line lengths, and
+    # manifest.json listing the catalogs and the deleted indexes. Record n
+    # is line n % max_len of catalog n // max_len, so read() is one seek.
+    # delete() only marks indexes in the manifest; nothing is rewritten.
+    # Opening an existing tub appends to it. manifest.json's current_index
+    # is only written on roll(), flush() and close(), so opening also counts
+    # the records actually in the last catalog (see recover()).
+
+    def __init__(self, path, max_len=1000):
+        self.path = path
+        self.manifest_path = f'{path}/manifest.json'
+        self.catalog_file = None
+        self.open_catalog = None
+        self.line_lengths = []
+        self.offsets = {} # catalog number -> line start offsets
+        if os.path.isfile(self.manifest_path):
+            self.load_manifest()
+        else:
+            os.makedirs(path, exist_ok=True)
+            self.inputs = []
+            self.types = []
+            self.metadata = {}
+            self.created_at = time.time()
+            self.paths = []
+            self.current_index = 0
+            self.max_len = max_len
+            self.deleted_indexes = set()
+            self.write_manifest()
+
+    def __len__(self):
+        return self.current_index - len(self.deleted_indexes)
+
+    def load_manifest(self):
+        with open(self.manifest_path) as manifest_file:
+            lines = manifest_file.read().splitlines()
+        self.inputs = json.loads(lines[0])
+        self.types = json.loads(lines[1])
+        self.metadata = json.loads(lines[2])
+        self.created_at = json.loads(lines[3]).get('created_at', time.time())
+        manifest = json.loads(lines[4])
+        self.paths = manifest['paths']
+        self.current_index = manifest['current_index']
+        self.max_len = manifest['max_len']
+        self.deleted_indexes = set(manifest['deleted_indexes'])
+        self.recover()
+
+    def recover(self):
+        # after a crash the last catalog can hold records the manifest
+        # doesn't count yet. Nothing is written here, as a reader may open
+        # a tub that's still recording; roll() tidies up before appending
+        if not self.paths:
+            return
+        catalog_num = max(catalog_number(name) for name in self.paths)
+        lengths = complete_lines(self.catalog_path(catalog_num))
+        current_index = catalog_num * self.max_len + len(lengths)
+        if current_index != self.current_index:
+            print(f"{self.path}: {current_index} records in the catalogs, "
+                  f"manifest says {self.current_index}")
+            self.current_index = current_index
+        offsets = [0]
+        for length in lengths:
+            offsets.append(offsets[-1] + length)
+        self.offsets[catalog_num] = offsets
+
+    def write_manifest(self):
+        lines = [
+            self.inputs,
+            self.types,
+            self.metadata,
+            {'created_at': self.created_at},
+            {
+                'paths': self.paths,
+                'current_index': self.current_index,
+                'max_len': self.max_len,
+                'deleted_indexes': sorted(self.deleted_indexes),
+            },
+        ]
+        with open(self.manifest_path + '.tmp', 'w') as manifest_file:
+            manifest_file.write('\n'.join(json.dumps(line) for line in lines) + '\n')
+        os.replace(self.manifest_path + '.tmp', self.manifest_path)
+
+    def catalog_path(self, catalog_num):
+        return f'{self.path}/catalog_{catalog_num}.catalog'
+
+    def append(self, record):
+        if not self.inputs:
+            self.inputs = list(record)
+            self.types = [tub_type(key, value) for key, value in record.items()]
+        index = self.current_index
+        catalog_num = index // self.max_len
+        if catalog_num != self.open_catalog:
+            self.roll(catalog_num)
+        line = json.dumps({'_index': index,
+                           '_timestamp_ms': int(time.time() * 1000),
+                           **record}) + '\n'
+        data = line.encode('utf-8')
+        self.catalog_file.write(data)
+        self.line_lengths.append(len(data))
+        self.current_index += 1
+        return index
+
+    def roll(self, catalog_num):
+        if self.catalog_file is not None:
+            self.close_catalog()
+        name = f'catalog_{catalog_num}.catalog'
+        if name not in self.paths:
+            self.paths.append(name)
+        catalog_path = self.catalog_path(catalog_num)
+        if os.path.isfile(catalog_path + '_manifest'):
+            # stale once we append; rewritten when the catalog next closes
+            os.remove(catalog_path + '_manifest')
+        self.line_lengths = complete_lines(catalog_path)
+        if os.path.isfile(catalog_path):
+            # a line cut off mid-write
+            with open(catalog_path, 'r+b') as catalog_file:
+                catalog_file.truncate(sum(self.line_lengths))
+        self.offsets.pop(catalog_num, None)
+        self.catalog_file = open(catalog_path, 'ab')
+        self.open_catalog = catalog_num
+        self.write_manifest()
+
+    def close_catalog(self):
+        self.catalog_file.close()
+        self.catalog_file = None
+        catalog_manifest = {
+            'path': f'catalog_{self.open_catalog}.catalog',
+            'created_at': time.time(),
+            'start_index': self.open_catalog * self.max_len,
+            'line_lengths': self.line_lengths,
+        }
+        with open(self.catalog_path(self.open_catalog) + '_manifest', 'w') as manifest_file:
+            json.dump(catalog_manifest, manifest_file)
+        self.offsets.pop(self.open_catalog, None)
+        self.open_catalog = None
+
+    def read_line_lengths(self, catalog_num):
+        catalog_path = self.catalog_path(catalog_num)
+        if not os.path.isfile(catalog_path):
+            return []
+        if os.path.isfile(catalog_path + '_manifest'):
+            with open(catalog_path + '_manifest') as manifest_file:
+                return json.load(manifest_file)['line_lengths']
+        # no manifest (closed uncleanly, or still open): measure the lines
+        return complete_lines(catalog_path)
+
+    def line_offsets(self, catalog_num):
+        if catalog_num == self.open_catalog:
+            self.catalog_file.flush()
+            lengths = self.line_lengths
+        elif catalog_num in self.offsets:
+            return self.offsets[catalog_num]
+        else:
+            lengths = self.read_line_lengths(catalog_num)
+        offsets = [0]
+        for length in lengths:
+            offsets.append(offsets[-1] + length)
+        if catalog_num != self.open_catalog:
+            self.offsets[catalog_num] = offsets
+        return offsets
+
+    def read(self, index):
+        # None for a deleted record
+        if not 0 <= index < self.current_index:
+            raise IndexError(f'record {index} not in tub ({self.current_index} records)')
+        if index in self.deleted_indexes:
+            return None
+        catalog_num, line_num = divmod(index, self.max_len)
+        offsets = self.line_offsets(catalog_num)
+        with open(self.catalog_path(catalog_num), 'rb') as catalog_file:
+            catalog_file.seek(offsets[line_num])
+            return json.loads(catalog_file.read(offsets[line_num + 1] - offsets[line_num]))
+
+    def flush(self, sync=False):
+        # everything appended so far on disk and counted in the manifest
+        if self.catalog_file is not None:
+            self.catalog_file.flush()
+            if sync:
+                os.fsync(self.catalog_file.fileno())
+        self.write_manifest()
+
+    def truncate(self, length):
+        # drops every record from index length on, e.g. the ones appended
+        # after the last flush() of a run that didn't close
+        if self.catalog_file is not None:
+            self.close_catalog()
+        last_catalog, lines = divmod(length, self.max_len)
+        for name in list(self.paths):
+            catalog_num = catalog_number(name)
+            catalog_path = self.catalog_path(catalog_num)
+            if catalog_num < last_catalog:
+                continue
+            if catalog_num == last_catalog and lines:
+                with open(catalog_path, 'rb') as catalog_file:
+                    lengths = [len(line) for line in catalog_file][:lines]
+                with open(catalog_path, 'r+b') as catalog_file:
+                    catalog_file.truncate(sum(lengths))
+            else:
+                self.paths.remove(name)
+                if os.path.isfile(catalog_path):
+                    os.remove(catalog_path)
+            # rewritten with the right lengths when the catalog next closes
+            if os.path.isfile(catalog_path + '_manifest'):
+                os.remove(catalog_path + '_manifest')
+            self.offsets.pop(catalog_num, None)
+        self.current_index = length
+        self.deleted_indexes = {index for index in self.deleted_indexes if index < length}
+        self.write_manifest()
+
+    def delete(self, start, stop):
+        # marks records start..stop-1 deleted
+        self.deleted_indexes.update(range(start, min(stop, self.current_index)))
+        self.write_manifest()
+
+    def restore(self, start, stop):
+        self.deleted_indexes.difference_update(range(start, stop))
+        self.write_manifest()
+
+    def close(self, sync=False):
+        if self.catalog_file is not None:
+            if sync:
+                self.catalog_file.flush()
+                os.fsync(self.catalog_file.fileno())
+            self.close_catalog()
+        self.write_manifest()
+
+
+def catalog_number(name):
+    # 'catalog_12.catalog' -> 12
+    return int(name.split('_')[1].split('.')[0])
+
+
+def complete_lines(catalog_path):
+    # lengths of the newline-terminated lines, leaving out a partial last one
+    if not os.path.isfile(catalog_path):
+        return []
+    with open(catalog_path, 'rb') as catalog_file:
+        return [len(line) for line in catalog_file if line.endswith(b'\n')]
+
+
+def tub_type(key, value):
+    if key == 'image':
+        return 'image_array'
+    if isinstance(value, bool):
+        return 'boolean'
+    if isinstance(value, int):
+        return 'int'
+    if isinstance(value, float):
+        return 'float'
+    return 'str'
+
+
+class ColumnStore:
+
+    # One raw file per column (<name>.bin) plus schema.json. Rows are filled
+    # into preallocated blocks and each column is appended a whole block at
+    # a time, so every file is a plain C-order array that np.memmap can open
+    # (see load_columnar). columns is a list of (name, dtype, shape).
+
+    def __init__(self, path, columns, block_bytes=8 * 1024 * 1024):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.columns = columns
+        row_bytes = sum(np.dtype(dtype).itemsize * int(np.prod(shape))
+                        for _, dtype, shape in columns)
+        self.block_rows = max(1, block_bytes // row_bytes)
+        self.blocks = {name: np.zeros((self.block_rows,) + tuple(shape), dtype)
+                       for name, dtype, shape in columns}
+        self.files = {name: open(f'{path}/{name}.bin', 'wb') for name, _, _ in columns}
+        self.fill = 0
+        self.rows = 0
+        self.write_schema()
+
+    def append(self, row):
+        for name, block in self.blocks.items():
+            block[self.fill] = row[name]
+        self.fill += 1
+        if self.fill == self.block_rows:
+            self.write_block()
+
+    def write_block(self):
+        if not self.fill:
+            return
+        for name, block in self.blocks.items():
+            self.files[name].write(block[:self.fill].tobytes())
+            self.files[name].flush()
+        self.rows += self.fill
+        self.fill = 0
+        self.write_schema()
+
+    def write_schema(self):
+        schema = {
+            'rows': self.rows,
+            'block_rows': self.block_rows,
+            'columns': {name: {'dtype': np.dtype(dtype).str, 'shape': list(shape)}
+                        for name, dtype, shape in self.columns},
+        }
+        with open(f'{self.path}/schema.json.tmp', 'w') as schema_file:
+            json.dump(schema, schema_file, indent=2)
+        os.replace(f'{self.path}/schema.json.tmp', f'{self.path}/schema.json')
+
+    def close(self):
+        self.write_block()
+        for column_file in self.files.values():
+            column_file.close()
+
+
+class ColumnarRecorder:
+
+    # Telemetry as typed columns (config.TELEMETRY_DTYPES) and images as one
+    # contiguous uint8 array, instead of a file per frame.
+
+    def __init__(self, conf):
+        time_str = time.strftime("%m_%d_%Y/%H_%M_%S")
+        self.dir = f'{os.getcwd()}/../data/{time_str}'
+        os.makedirs(self.dir, exist_ok=True)
+        with open(f'{self.dir}/conf', 'x') as conf_file:
+            conf_file.write(json.dumps(conf))
+        self.telem_cols = [col for col in config.TELEMETRY_COLUMNS[conf['telem_type']]
+                           if col != 'image']
+        self.image_depth = conf['image_depth']
+        # created with the first frame, once the image size is known
+        self.store = None
+        self.lock = threading.Lock()
+        print(f"DATA DIR: {self.dir}")
+
+    def record(self, json_packet):
+        # decode outside the lock so workers can do that in parallel
+        pixels = json_packet.frame.view(self.image_depth)
+        with self.lock:
+            if self.store is None:
+                columns = [('image', 'uint8', pixels.shape)]
+                columns += column_specs(self.telem_cols, json_packet)
+                self.store = ColumnStore(self.dir, columns, config.columnar_block_bytes)
+            json_packet['image'] = pixels
+            self.store.append(json_packet)
+            return self.store.rows + self.store.fill - 1
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+            print(f"{self.store.rows} rows written to {self.dir}")
+
+
+def column_specs(names, row):
+    # (name, dtype, shape) for the names in row. dtypes are from
+    # config.TELEMETRY_DTYPES; vector lengths (e.g. lidar, which depends on
+    # the lidar config) are taken from row
+    columns = []
+    for name in names:
+        if name not in row:
+            continue
+        dtype = config.TELEMETRY_DTYPES.get(name, 'float32')
+        if isinstance(dtype, tuple):
+            dtype = dtype[0]
+        shape = np.shape(row[name])
+        if 0 in shape:
+            print(f"{name} is empty, not recording it")
+            continue
+        columns.append((name, dtype, shape))
+    return columns
+
+
+def load_columnar(path, mmap_mode='r'):
+    # {column: memory-mapped array} for a ColumnStore directory. Row count
+    # comes from the file sizes, so a store that wasn't closed cleanly still
+    # opens with every complete block.
+    with open(f'{path}/schema.json') as schema_file:
+        schema = json.load(schema_file)
+    specs = {}
+    rows = None
+    for name, spec in schema['columns'].items():
+        dtype = np.dtype(spec['dtype'])
+        shape = tuple(spec['shape'])
+        row_bytes = dtype.itemsize * int(np.prod(shape))
+        file_rows = os.path.getsize(f'{path}/{name}.bin') // row_bytes
+        rows = file_rows if rows is None else min(rows, file_rows)
+        specs[name] = (dtype, shape)
+    if not rows:
+        return {name: np.empty((0,) + shape, dtype) for name, (dtype, shape) in specs.items()}
+    return {name: np.memmap(f'{path}/{name}.bin', dtype=dtype, mode=mmap_mode,
+                            shape=(rows,) + shape)
+            for name, (dtype, shape) in specs.items()}
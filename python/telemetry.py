@@ -0,0 +1,135 @@
+# Telemetry packets and the JSON decoding behind them.
+#
+# The camera frame is by far the largest part of a telemetry message: a
+# base64 string of the encoded PNG/JPG. loads() slices it out of the raw
+# message before handing the rest to the JSON parser, and TelemetryPacket
+# only base64-decodes it the first time image_bytes is read. Its Frame
+# decodes the pixels once, for the pilot and the recorders to share.
+
+import base64
+import json
+
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from config import json_backend
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if json_backend == 'orjson' and orjson is not None:
+    json_loads = orjson.loads
+else:
+    json_loads = json.loads
+
+IMAGE_KEY = b'"image":'
+
+
+class Frame:
+
+    __slots__ = ('encoded', '_pixels')
+
+    def __init__(self, encoded):
+        self.encoded = encoded
+        self._pixels = None
+
+    @property
+    def pixels(self):
+        # decoded on first use, then shared (treat as read-only)
+        if self._pixels is None:
+            self._pixels = np.asarray(Image.open(BytesIO(self.encoded)))
+        return self._pixels
+
+    def view(self, depth):
+        # depth 1 takes channel 1 like the old getchannel(1) calls did; the
+        # sim's grayscale images have three identical channels anyway
+        pixels = self.pixels
+        if pixels.ndim == 2:
+            return pixels
+        if depth == 1:
+            return pixels[:, :, 1]
+        return pixels[:, :, :depth]
+
+    def image(self, depth):
+        return Image.fromarray(self.view(depth))
+
+
+class FrameRing:
+
+    # Preallocated frame slots sized from cam_conf. put() casts a frame
+    # straight into the next slot in the dtype the model wants and returns a
+    # view of the slot, so nothing is allocated per frame. A slot is reused
+    # after `size` more frames, so don't hold on to views longer than that.
+
+    def __init__(self, cam_conf, depth, dtype='float32', size=8):
+        self.depth = depth
+        self.dtype = dtype
+        self.size = size
+        self.index = -1
+        self.slots = None
+        h, w = int(cam_conf['img_h']), int(cam_conf['img_w'])
+        # zero means the sim's default size, which we only learn from a frame
+        if h and w:
+            self.allocate((h, w) if depth == 1 else (h, w, depth))
+
+    def allocate(self, shape):
+        self.slots = np.empty((self.size,) + shape, dtype=self.dtype)
+
+    def put(self, pixels):
+        if self.slots is None or self.slots.shape[1:] != pixels.shape:
+            if self.slots is not None:
+                print(f"frame size changed to {pixels.shape}, reallocating ring")
+            self.allocate(pixels.shape)
+        self.index = (self.index + 1) % self.size
+        slot = self.slots[self.index]
+        np.copyto(slot, pixels, casting='unsafe')
+        return slot
+
+
+class TelemetryPacket(dict):
+
+    __slots__ = ('_image_bytes', '_frame')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._image_bytes = None
+        self._frame = None
+
+    @classmethod
+    def from_encoded(cls, fields, encoded):
+        # a packet for an image that is already bytes, e.g. read from disk
+        json_packet = cls(fields)
+        json_packet._image_bytes = encoded
+        return json_packet
+
+    @property
+    def image_bytes(self):
+        # encoded PNG/JPG/TGA bytes as sent by the sim
+        if self._image_bytes is None:
+            self._image_bytes = base64.b64decode(self['image'])
+        return self._image_bytes
+
+    @property
+    def frame(self):
+        if self._frame is None:
+            self._frame = Frame(self.image_bytes)
+        return self._frame
+
+
+def loads(msg):
+    # msg is the raw bytes of one message from the sim
+    key = msg.find(IMAGE_KEY)
+    if key < 0:
+        return json_loads(msg)
+    quote = msg.find(b'"', key + len(IMAGE_KEY))
+    # base64 has no quotes or escapes, so the next quote closes the string
+    end = msg.find(b'"', quote + 1) if quote >= 0 else -1
+    if end < 0 or msg[key + len(IMAGE_KEY):quote].strip():
+        return json_loads(msg)
+    json_packet = json_loads(msg[:quote + 1] + msg[end:])
+    json_packet['image'] = msg[quote + 1:end].decode('ascii')
+    return json_packet